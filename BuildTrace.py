@@ -0,0 +1,95 @@
+"""
+Class to record timing of build pipeline stages
+* Author(s): Alexander Kirillov
+* Version: 4.0
+
+Records wall time, CPU time of the thread running the stage and resource usage of subprocesses
+(e.g. make) for each stage, and saves them as JSON report or as Chrome trace file (open in
+chrome://tracing or https://ui.perfetto.dev)
+"""
+
+import os
+import time
+import json
+import threading
+import contextlib
+try:
+    import resource
+except ImportError:
+    # not available on Windows; subprocess usage is not recorded there
+    resource = None
+
+class BuildTrace:
+    def __init__(self):
+        # list of dictionaries, one per finished stage
+        self.stages = []
+        self.lock = threading.Lock()
+
+    # context manager recording one stage; yields dictionary where the stage can add its own
+    # counters, e.g. bytes_copied. Usage of subprocesses is only known for the whole process, so a
+    # stage which runs while another thread runs subprocesses should have subprocesses = False
+    @contextlib.contextmanager
+    def stage(self, name, board = None, subprocesses = True):
+        info = {}
+        children_before = resource.getrusage(resource.RUSAGE_CHILDREN) if resource and subprocesses else None
+        start_wall = time.time()
+        start = time.perf_counter()
+        start_cpu = time.thread_time()
+        try:
+            yield info
+        finally:
+            record = {
+                "stage": name,
+                "board": board,
+                "start": start_wall,
+                "wall_time": time.perf_counter() - start,
+                "cpu_time": time.thread_time() - start_cpu,
+                "pid": os.getpid(),
+                "thread": threading.get_ident(),
+            }
+            if children_before is not None:
+                children = resource.getrusage(resource.RUSAGE_CHILDREN)
+                record["subprocess_user_time"] = children.ru_utime - children_before.ru_utime
+                record["subprocess_system_time"] = children.ru_stime - children_before.ru_stime
+                record["subprocess_max_rss"] = children.ru_maxrss
+            record.update(info)
+            with self.lock:
+                self.stages.append(record)
+
+    # adds stages recorded elsewhere, e.g. by another trace in a worker process
+    def add_stages(self, stages):
+        with self.lock:
+            self.stages += stages
+
+    # prints one line per stage
+    def print_summary(self):
+        for record in self.stages:
+            board = f"[{record['board']}] " if record['board'] else ""
+            line = f"{board}{record['stage']:20} {record['wall_time']:8.3f} s wall, {record['cpu_time']:8.3f} s CPU"
+            if record.get('subprocess_user_time'):
+                line += f", {record['subprocess_user_time'] + record['subprocess_system_time']:8.3f} s in subprocesses"
+            if record.get('bytes_copied'):
+                line += f", {record['bytes_copied']} bytes copied"
+            print(line)
+
+    def save_report(self, filename):
+        with open(filename, 'w', encoding = 'UTF-8') as report:
+            json.dump({"stages": self.stages}, report, indent = 2)
+
+    # saves stages as complete ('X') events of Chrome trace event format
+    def save_chrome_trace(self, filename):
+        events = []
+        for record in self.stages:
+            events.append({
+                "name": record["stage"],
+                "cat": record["board"] or "build",
+                "ph": "X",
+                "ts": int(record["start"] * 1e6),
+                "dur": int(record["wall_time"] * 1e6),
+                "pid": record["pid"],
+                "tid": record["thread"],
+                "args": {key: value for key, value in record.items()
+                         if key not in ("stage", "start", "wall_time", "pid", "thread")},
+            })
+        with open(filename, 'w', encoding = 'UTF-8') as trace:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Functions to validate board config files before building
+* Author(s): Alexander Kirillov
+* Version: 4.0
+
+Usage: ConfigValidator.py [--no-path-checks] [-j JOBS] CONFIG [CONFIG ...]
+
+Checks every config file against the schema below and reports all errors at once;
+several files are checked in parallel, and board names must be unique among them.
+Exits with non-zero status if any errors were found.
+"""
+
+import os
+import re
+import sys
+import shutil
+import argparse
+import configparser
+from concurrent.futures import ProcessPoolExecutor
+
+# supported chip variants for each chip family (see README.md); flash size and variant
+# templates of the package are only right for these
+CHIP_VARIANTS = {
+    'SAMD21': ['SAMD21E17A', 'SAMD21E18A', 'SAMD21G18A'],
+    'SAMD51': ['SAMD51G19A', 'SAMD51J19A', 'SAMD51J20A', 'SAMD51P20A'],
+    'SAME51': ['SAME51J19A', 'SAME54N20A', 'SAME54P20A'],
+}
+
+# options of [m4_usart_options], all required for SAMD51/SAME51
+M4_USART_OPTIONS = ['boot_usart_module', 'boot_usart_mask', 'boot_usart_bus_clock_index',
+                    'boot_usart_pad_settings', 'boot_usart_pad3', 'boot_usart_pad2', 'boot_usart_pad1',
+                    'boot_usart_pad0', 'boot_gclk_id_core', 'boot_gclk_id_slow']
+
+# returns True or False for boolean config value, as accepted by configparser
+# (1/0, yes/no, true/false, on/off); raises ValueError for anything else
+def parse_bool(value):
+    try:
+        return(configparser.ConfigParser.BOOLEAN_STATES[value.strip().lower()])
+    except KeyError:
+        raise ValueError(f"Not a boolean: {value}")
+
+# each check returns error message for invalid value, or None
+def matches(pattern, description):
+    def check(value):
+        return(None if re.fullmatch(pattern, value) else f"must be {description}, not '{value}'")
+    return(check)
+
+def one_of(choices):
+    def check(value):
+        return(None if value in choices else f"must be one of {', '.join(choices)}, not '{value}'")
+    return(check)
+
+def boolean(value):
+    try:
+        parse_bool(value)
+        return(None)
+    except ValueError:
+        return(f"must be 1/0, yes/no, true/false or on/off, not '{value}'")
+
+def volume_label(value):
+    if len(value) > 11:
+        return(f"must be at most 11 characters, not {len(value)}")
+    bad = sorted(set(value) & set('"*+,./:;<=>?[\\]|'))
+    if bad:
+        return(f"must not contain {' '.join(bad)}")
+    return(None)
+
+def any_value(value):
+    return(None)
+
+PIN = matches(r'PIN_P[A-D]\d\d', "a pin name like PIN_PA09")
+HEX16 = matches(r'0x[0-9A-Fa-f]{4}', "a 16-bit hex number like 0x03EB")
+URL = matches(r'https?://\S+', "an http(s) URL")
+
+# section -> key -> (required, check)
+SCHEMA = {
+    'hardware': {
+        'chip_family': (True, one_of(list(CHIP_VARIANTS))),
+        'chip_variant': (True, any_value),
+        'crystalless': (True, boolean),
+        'led_pin': (False, PIN),
+        'board_neopixel_pin': (False, PIN),
+        'board_neopixel_count': (False, matches(r'[1-9]\d*', "a positive number")),
+        'board_rgbled_clock_pin': (False, PIN),
+        'board_rgbled_data_pin': (False, PIN),
+        'led_tx_pin': (False, PIN),
+        'led_rx_pin': (False, PIN),
+    },
+    'usb': {
+        'usb_vid': (True, HEX16),
+        'usb_pid': (True, HEX16),
+        'volume_label': (True, volume_label),
+    },
+    'names': {
+        'vendor_name': (True, matches(r'[a-z0-9_]+', "lower case letters, digits and _")),
+        'vendor_name_long': (True, any_value),
+        'info_url': (True, URL),
+        'help_url': (True, URL),
+        'vendor_email': (True, matches(r'[^@\s]+@[^@\s]+\.[^@\s]+', "an e-mail address")),
+        'board_name': (True, matches(r'[a-z0-9_]+', "lower case letters, digits and _")),
+        'board_name_long': (True, any_value),
+        'board_define_name': (True, matches(r'[A-Z][A-Z0-9_]*', "upper case letters, digits and _")),
+        'package_name': (True, any_value),
+        'package_version': (True, matches(r'\d+\.\d+\.\d+(-[0-9A-Za-z.]+)?', "a version like 4.0.2")),
+        'package_url': (False, URL),
+    },
+    'paths': {
+        'arduino15': (True, any_value),
+        'make_path': (False, any_value),
+        'gcc_version': (False, any_value),
+        'package_index': (False, any_value),
+        'footprint_history': (False, any_value),
+    },
+}
+
+# checks parsed config file against the schema; returns list of error messages
+def check_values(config_file):
+    errors = []
+    for section, keys in SCHEMA.items():
+        if section not in config_file:
+            errors.append(f"missing section [{section}]")
+            continue
+        for key, value in config_file[section].items():
+            if key not in keys:
+                errors.append(f"[{section}] {key.upper()}: unknown option")
+            elif not value:
+                errors.append(f"[{section}] {key.upper()}: no value provided")
+            else:
+                error = keys[key][1](value)
+                if error:
+                    errors.append(f"[{section}] {key.upper()}: {error}")
+        for key, (required, check) in keys.items():
+            if required and key not in config_file[section]:
+                errors.append(f"[{section}] {key.upper()}: missing")
+    for section in ['m4_usart_options', 'bootloader_extras']:
+        if section not in config_file:
+            errors.append(f"missing section [{section}]")
+            continue
+        for key, value in config_file[section].items():
+            if not re.fullmatch(r'[a-z_][a-z0-9_]*', key):
+                errors.append(f"[{section}] {key.upper()}: not a valid macro name")
+            elif not value:
+                errors.append(f"[{section}] {key.upper()}: no value provided")
+    # dependencies between options; only checked where the options they depend on are valid
+    hardware = config_file['hardware'] if 'hardware' in config_file else {}
+    family = hardware.get('chip_family')
+    if family in CHIP_VARIANTS:
+        if hardware.get('chip_variant') and hardware['chip_variant'] not in CHIP_VARIANTS[family]:
+            errors.append(f"[hardware] CHIP_VARIANT: must be one of {', '.join(CHIP_VARIANTS[family])} "
+                          f"for {family}, not '{hardware['chip_variant']}'")
+        if 'm4_usart_options' in config_file:
+            usart_options = config_file['m4_usart_options']
+            if family == 'SAMD21':
+                if len(usart_options):
+                    errors.append("[m4_usart_options]: must be empty (commented out) for SAMD21")
+            else:
+                for key in M4_USART_OPTIONS:
+                    if key not in usart_options:
+                        errors.append(f"[m4_usart_options] {key.upper()}: required for {family}")
+    for key, other in [('board_neopixel_pin', 'board_neopixel_count'), ('board_neopixel_count', 'board_neopixel_pin'),
+                       ('board_rgbled_clock_pin', 'board_rgbled_data_pin'),
+                       ('board_rgbled_data_pin', 'board_rgbled_clock_pin')]:
+        if key in hardware and other not in hardware:
+            errors.append(f"[hardware] {other.upper()}: required if {key.upper()} is given")
+    return(errors)
+
+# checks that files and programs referred to by config file exist; returns list of error messages
+def check_paths(config_file, data_directory):
+    errors = []
+    for filename in ['variant.cpp', 'variant.h']:
+        if not os.path.isfile(f"{data_directory}/{filename}"):
+            errors.append(f"{filename} not found in {data_directory}")
+    paths = config_file['paths']
+    tools_dir = os.path.join(os.path.expanduser('~'), paths['arduino15'], 'packages/adafruit/tools/arm-none-eabi-gcc')
+    if not os.path.isdir(tools_dir):
+        errors.append(f"[paths] ARDUINO15: {tools_dir} not found; is Adafruit SAMD boards package installed?")
+    elif 'gcc_version' in paths and not os.path.isdir(f"{tools_dir}/{paths['gcc_version']}"):
+        errors.append(f"[paths] GCC_VERSION: {tools_dir}/{paths['gcc_version']} not found")
+    make_path = paths.get('make_path')
+    if shutil.which('make', path = make_path) is None:
+        errors.append(f"[paths] MAKE_PATH: GNU make not found in {make_path or 'PATH'}")
+    if 'package_index' in paths:
+        index_directory = os.path.dirname(os.path.join(data_directory, paths['package_index']))
+        if not os.path.isdir(index_directory):
+            errors.append(f"[paths] PACKAGE_INDEX: directory {index_directory} not found")
+    return(errors)
+
+# validates one config file; returns (board name, or None if not known, list of error messages)
+def validate_config(filename, paths = True):
+    if not os.path.isfile(filename):
+        return(None, ["file not found"])
+    config_file = configparser.ConfigParser()
+    try:
+        config_file.read(filename)
+    except configparser.Error as e:
+        return(None, [f"can't parse: {e}"])
+    errors = check_values(config_file)
+    board_name = config_file['names'].get('board_name') if 'names' in config_file else None
+    if paths and 'paths' in config_file and 'arduino15' in config_file['paths']:
+        errors += check_paths(config_file, os.path.dirname(os.path.abspath(filename)))
+    return(board_name, errors)
+
+# returns filenames without repeated files, e.g. the same file given twice or by another path;
+# the first name given for each file is kept
+def unique_files(filenames):
+    seen = set()
+    unique = []
+    for filename in filenames:
+        path = os.path.realpath(filename)
+        if path not in seen:
+            seen.add(path)
+            unique.append(filename)
+    return(unique)
+
+# validates many config files in parallel, and checks that board names are unique.
+# Returns dictionary {filename: list of error messages}
+def validate_configs(filenames, jobs = None, paths = True):
+    filenames = unique_files(filenames)
+    if len(filenames) == 1 or jobs == 1:
+        # not worth starting worker processes
+        results = [validate_config(filename, paths) for filename in filenames]
+    else:
+        with ProcessPoolExecutor(max_workers = jobs) as executor:
+            results = list(executor.map(validate_config, filenames, [paths] * len(filenames),
+                                        chunksize = max(1, len(filenames) // (4 * (os.cpu_count() or 1)))))
+    errors = {}
+    board_names = {}
+    for filename, (board_name, file_errors) in zip(filenames, results):
+        errors[filename] = file_errors
+        if board_name:
+            board_names.setdefault(board_name, []).append(filename)
+    for board_name, board_files in board_names.items():
+        for filename in board_files:
+            if len(board_files) > 1:
+                others = ', '.join(other for other in board_files if other != filename)
+                errors[filename].append(f"[names] BOARD_NAME: {board_name} is also used in {others}")
+    return(errors)
+
+# prints errors of each file; returns total number of errors
+def print_errors(errors):
+    count = 0
+    for filename, file_errors in errors.items():
+        for error in file_errors:
+            print(f"{filename}: {error}")
+        count += len(file_errors)
+    return(count)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Validate board config files.')
+    parser.add_argument('config', metavar = 'CONFIG', nargs = '+', help = 'board config file(s)')
+    parser.add_argument('--no-path-checks', action = 'store_true',
+                        help = 'do not check that toolchain, make and variant files exist')
+    parser.add_argument('-j', '--jobs', type = int, default = None,
+                        help = 'number of files checked at the same time (default: number of CPUs)')
+    args = parser.parse_args()
+    args.config = unique_files(args.config)
+    count = print_errors(validate_configs(args.config, args.jobs, not args.no_path_checks))
+    if count:
+        print(f"{count} error(s) in {len(args.config)} config file(s)")
+        sys.exit(1)
+    print(f"{len(args.config)} config file(s) OK")
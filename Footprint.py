@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Class to analyze flash and RAM usage of built bootloader
+* Author(s): Alexander Kirillov
+* Version: 4.0
+
+Usage: Footprint.py MAPFILE [ELFFILE] [--budget BYTES]
+       Footprint.py --history FILE
+
+Uses the linker map file for usage of each object file and ELF section headers for section
+types; results of each build can be kept in a history file, to compare boards and versions.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import struct
+import argparse
+import tempfile
+from PackageIndex import file_mode
+
+SHF_WRITE = 0x1
+SHF_ALLOC = 0x2
+SHT_NOBITS = 8
+# sections which are not loaded; only used if there is no ELF file to tell
+NON_ALLOC_PREFIXES = ('.debug', '.comment', '.ARM.attributes', '.stab', '.note.gnu', '.gnu.attributes')
+# sections which take RAM but have no contents in flash (NOBITS, e.g. NOLOAD in linker script);
+# only used if there is no ELF file to tell
+NOBITS_PREFIXES = ('.bss', '.sbss', '.noinit', '.stack', '.heap', 'COMMON')
+
+# returns {section name: (address, size, flags, type)} from ELF section headers,
+# or empty dictionary if file is not an ELF file
+def elf_sections(filename):
+    with open(filename, 'rb') as elf:
+        data = elf.read()
+    if data[:4] != b'\x7fELF':
+        return {}
+    is_64bit = data[4] == 2
+    endian = '<' if data[5] == 1 else '>'
+    if is_64bit:
+        shoff, = struct.unpack_from(endian + 'Q', data, 0x28)
+        shentsize, shnum, shstrndx = struct.unpack_from(endian + 'HHH', data, 0x3a)
+        header = struct.Struct(endian + 'IIQQQQIIQQ')
+    else:
+        shoff, = struct.unpack_from(endian + 'I', data, 0x20)
+        shentsize, shnum, shstrndx = struct.unpack_from(endian + 'HHH', data, 0x2e)
+        header = struct.Struct(endian + 'IIIIIIIIII')
+    headers = [header.unpack_from(data, shoff + i * shentsize) for i in range(shnum)]
+    names_offset = headers[shstrndx][4]
+    sections = {}
+    for name, sh_type, flags, address, offset, size, *rest in headers:
+        start = names_offset + name
+        section_name = data[start:data.index(b'\0', start)].decode('ascii', 'replace')
+        if section_name:
+            sections[section_name] = (address, size, flags, sh_type)
+    return sections
+
+# parses GNU ld map file. Returns list of memory regions as (name, origin, length, attributes),
+# and list of output sections as dictionaries with keys name, address, size, load_address and
+# inputs, which is a list of (input section, size, object file)
+def parse_map(filename):
+    regions = []
+    sections = []
+    number = r'0x([0-9a-fA-F]+)'
+    output_re = re.compile(r'^(\S+)?\s+' + number + r'\s+' + number + r'(?:\s+load address ' + number + ')?\s*$')
+    input_re = re.compile(r'^ (\S+)?\s+' + number + r'\s+' + number + r'\s+(\S.*)$')
+    with open(filename, 'r', encoding = 'UTF-8', errors = 'replace') as mapfile:
+        part = None
+        pending = None
+        for line in mapfile:
+            line = line.rstrip('\n')
+            if line.startswith('Memory Configuration'):
+                part = 'memory'
+                continue
+            if line.startswith('Linker script and memory map'):
+                part = 'map'
+                continue
+            if part == 'memory':
+                fields = line.split()
+                if len(fields) >= 3 and fields[1].startswith('0x') and fields[0] != '*default*':
+                    regions.append((fields[0], int(fields[1], 16), int(fields[2], 16),
+                                    fields[3] if len(fields) > 3 else ''))
+                continue
+            if part != 'map' or not line.strip():
+                continue
+            # long section names are on a line of their own, address and size follow on next line
+            if pending is not None and line[0] == ' ' and line.lstrip().startswith('0x'):
+                line = pending + line
+            pending = None
+            match = output_re.match(line)
+            if match and not line.startswith(' '):
+                sections.append({'name': match.group(1), 'address': int(match.group(2), 16),
+                                 'size': int(match.group(3), 16),
+                                 'load_address': int(match.group(4), 16) if match.group(4) else None,
+                                 'inputs': []})
+                continue
+            match = input_re.match(line)
+            if match and sections:
+                size = int(match.group(3), 16)
+                if size:
+                    sections[-1]['inputs'].append((match.group(1), size, object_name(match.group(4))))
+                continue
+            fields = line.split()
+            if len(fields) == 1 and (fields[0].startswith('.') or fields[0] == 'COMMON'):
+                pending = line
+    return regions, sections
+
+# short name of object file: file name, and archive member for libraries
+def object_name(path):
+    path = path.strip()
+    match = re.match(r'(.*)\((.*)\)$', path)
+    if match:
+        return f"{os.path.basename(match.group(1))}({match.group(2)})"
+    return os.path.basename(path)
+
+class Footprint:
+    # map_file is linker map file, elf_file (optional) is the linked ELF file;
+    # flash_budget is the size of flash available, e.g. 8192 for SAMD21 bootloader
+    def __init__(self, map_file, elf_file = None, flash_budget = None):
+        self.flash_budget = flash_budget
+        elf = elf_sections(elf_file) if elf_file is not None and os.path.exists(elf_file) else {}
+        regions, sections = parse_map(map_file)
+        ram_regions = [region for region in regions if 'w' in region[3]]
+        self.ram_budget = sum(region[2] for region in ram_regions) if ram_regions else None
+        # {name: {'flash': bytes, 'ram': bytes}}
+        self.sections = {}
+        self.objects = {}
+        self.flash = 0
+        self.ram = 0
+        for section in sections:
+            in_flash, in_ram = self.classify(section, regions, elf)
+            if not (in_flash or in_ram):
+                continue
+            usage = {'flash': section['size'] if in_flash else 0, 'ram': section['size'] if in_ram else 0}
+            self.sections[section['name']] = usage
+            self.flash += usage['flash']
+            self.ram += usage['ram']
+            for input_section, size, obj in section['inputs']:
+                object_usage = self.objects.setdefault(obj, {'flash': 0, 'ram': 0})
+                object_usage['flash'] += size if in_flash else 0
+                object_usage['ram'] += size if in_ram else 0
+
+    # returns (in flash, in RAM) for output section. Sections are placed by memory regions
+    # of the linker script; e.g. initialized data is in RAM, but loaded from flash
+    def classify(self, section, regions, elf):
+        name = section['name']
+        if name in elf:
+            address, size, flags, sh_type = elf[name]
+            if not flags & SHF_ALLOC:
+                return(False, False)
+            nobits = sh_type == SHT_NOBITS
+        else:
+            if name.startswith(NON_ALLOC_PREFIXES):
+                return(False, False)
+            flags, nobits = None, name.startswith(NOBITS_PREFIXES)
+        def region(address):
+            for region_name, origin, length, attributes in regions:
+                if origin <= address < origin + length:
+                    return(attributes)
+            return(None)
+        if regions:
+            load_address = section['load_address'] if section['load_address'] is not None else section['address']
+            load_region = region(load_address)
+            run_region = region(section['address'])
+            in_flash = load_region is not None and 'w' not in load_region and not nobits
+            in_ram = run_region is not None and 'w' in run_region
+            return(in_flash, in_ram)
+        if flags is None:
+            return(False, False)
+        return(not nobits, bool(flags & SHF_WRITE))
+
+    def over_budget(self):
+        return(self.flash_budget is not None and self.flash > self.flash_budget) or \
+              (self.ram_budget is not None and self.ram > self.ram_budget)
+
+    def to_dict(self):
+        return({'flash': self.flash, 'ram': self.ram, 'flash_budget': self.flash_budget,
+                'ram_budget': self.ram_budget, 'sections': self.sections, 'objects': self.objects})
+
+    # prints usage of each section and of top objects by flash usage
+    def print_report(self, top = 10):
+        def budget(used, available):
+            if available is None:
+                return(f"{used} bytes")
+            return(f"{used} of {available} bytes ({100 * used / available:.1f}%), {available - used} left")
+        print(f"Flash: {budget(self.flash, self.flash_budget)}")
+        print(f"RAM:   {budget(self.ram, self.ram_budget)}")
+        print(f"{'section':24} {'flash':>8} {'ram':>8}")
+        for name, usage in self.sections.items():
+            print(f"{name:24} {usage['flash']:8} {usage['ram']:8}")
+        print(f"{'object':40} {'flash':>8} {'ram':>8}")
+        objects = sorted(self.objects.items(), key = lambda item: (-item[1]['flash'], -item[1]['ram']))
+        for name, usage in objects[:top]:
+            print(f"{name:40} {usage['flash']:8} {usage['ram']:8}")
+        if len(objects) > top:
+            print(f"... and {len(objects) - top} more objects")
+
+# adds footprint of given board version to history file, replacing earlier entry for the same
+# board and version. Returns the latest entry for the same board with a different version, if any
+def record_history(filename, board_name, version, footprint):
+    history = load_history(filename)
+    previous = None
+    for entry in history:
+        if entry['board'] == board_name and entry['version'] != version:
+            previous = entry
+    history = [entry for entry in history if (entry['board'], entry['version']) != (board_name, version)]
+    history.append(dict(footprint.to_dict(), board = board_name, version = version, time = time.time()))
+    directory = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(directory, exist_ok = True)
+    fd, temp_name = tempfile.mkstemp(dir = directory, suffix = '.tmp')
+    with os.fdopen(fd, 'w', encoding = 'UTF-8') as historyfile:
+        json.dump(history, historyfile, indent = 2)
+    os.chmod(temp_name, file_mode(filename))
+    os.replace(temp_name, filename)
+    return(previous)
+
+def load_history(filename):
+    if not os.path.exists(filename):
+        return([])
+    with open(filename, 'r', encoding = 'UTF-8') as historyfile:
+        return(json.load(historyfile))
+
+# prints one line per board and version, with change from previous version of the same board
+def print_history(filename):
+    previous = {}
+    print(f"{'board':24} {'version':12} {'flash':>8} {'change':>8} {'ram':>8} {'change':>8}")
+    for entry in sorted(load_history(filename), key = lambda entry: (entry['board'], entry['time'])):
+        last = previous.get(entry['board'])
+        flash_change = f"{entry['flash'] - last['flash']:+8}" if last else ''
+        ram_change = f"{entry['ram'] - last['ram']:+8}" if last else ''
+        print(f"{entry['board']:24} {entry['version']:12} {entry['flash']:8} {flash_change:>8} "
+              f"{entry['ram']:8} {ram_change:>8}")
+        previous[entry['board']] = entry
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Report flash and RAM usage of bootloader from linker map file.')
+    parser.add_argument('map_file', metavar = 'MAPFILE', nargs = '?', help = 'linker map file')
+    parser.add_argument('elf_file', metavar = 'ELFFILE', nargs = '?', help = 'linked ELF file (optional)')
+    parser.add_argument('--budget', type = lambda value: int(value, 0), default = None,
+                        help = 'flash available, e.g. 8192; exit with error if usage exceeds it')
+    parser.add_argument('--top', type = int, default = 10, help = 'number of objects to list (default: 10)')
+    parser.add_argument('--history', metavar = 'FILE', default = None, help = 'print sizes recorded in history file')
+    args = parser.parse_args()
+    if args.history:
+        print_history(args.history)
+    if args.map_file:
+        footprint = Footprint(args.map_file, args.elf_file, args.budget)
+        footprint.print_report(args.top)
+        if footprint.over_budget():
+            sys.exit(1)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+Class to serve built packages to Arduino IDE installs on the local network
+* Author(s): Alexander Kirillov
+* Version: 4.0
+
+Usage: MirrorServer.py [--host HOST] [--port PORT] [DIRECTORY]
+
+Serves package_<vendor>_index.json files and package archives found in DIRECTORY
+(default: build). Archive URLs in index files are rewritten to point at this server, so
+Arduino IDE can use http://<this machine>:<port>/package_<vendor>_index.json as additional
+boards manager URL without internet access. Supports ETag/If-None-Match and Range requests;
+files are sent with sendfile where the OS supports it.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import email.utils
+import urllib.parse
+from http import HTTPStatus
+
+ARCHIVE_SUFFIXES = ('.zip', '.tar.gz', '.tar.bz2')
+CONTENT_TYPES = {'.json': 'application/json', '.zip': 'application/zip', '.gz': 'application/gzip',
+                 '.bz2': 'application/x-bzip2'}
+INDEX_RE = re.compile(r'package_.+_index\.json')
+# directory is scanned again for a missing file at most this often, in seconds
+RESCAN_INTERVAL = 1.0
+# at most this many rewritten index files are cached; there is one for each index file and
+# host name clients use to reach this server
+INDEX_CACHE_SIZE = 32
+
+# returns (start, end) of requested byte range, end exclusive, or None if the whole file should
+# be sent (no range, or one this server doesn't handle, such as several ranges). Raises ValueError
+# if the range can't be satisfied
+def parse_range(header, size):
+    match = re.fullmatch(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*', header or '')
+    if not match or not (match.group(1) or match.group(2)):
+        return(None)
+    if not match.group(1):
+        # suffix range: last N bytes
+        length = int(match.group(2))
+        if length == 0 or size == 0:
+            raise ValueError(f"Range {header} not satisfiable")
+        return(max(0, size - length), size)
+    start = int(match.group(1))
+    end = int(match.group(2)) + 1 if match.group(2) else size
+    if match.group(2) and end <= start:
+        # invalid range, ignored
+        return(None)
+    if start >= size:
+        raise ValueError(f"Range {header} not satisfiable")
+    return(start, min(end, size))
+
+# True if ETag matches one of the tags of If-None-Match header (weak comparison)
+def etag_matches(header, etag):
+    tags = [tag.strip() for tag in header.split(',')]
+    return('*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags])
+
+# True if ETag matches If-Range header (strong comparison: a weak tag never matches). If-Range
+# with a date instead of a tag never matches either, so the whole file is sent
+def etag_matches_strong(header, etag):
+    return(header.strip() == etag)
+
+# returns status line and headers of HTTP response
+def response_head(status, headers):
+    lines = [f"HTTP/1.1 {status.value} {status.phrase}"] + [f"{key}: {value}" for key, value in headers.items()]
+    return(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+class MirrorServer:
+    def __init__(self, directory = 'build', host = '0.0.0.0', port = 8000, quiet = False):
+        self.directory = directory
+        self.host = host
+        self.port = port
+        self.quiet = quiet
+        # {url name: file name}
+        self.files = {}
+        self.last_scan = 0
+        # {file name: (size, mtime, ETag)}
+        self.etags = {}
+        # {(file name, base URL): (size, mtime, rewritten index, ETag)}, oldest first
+        self.indexes = {}
+        self.server = None
+        self.scan()
+
+    # finds index files and package archives in directory tree; both are served by their file name.
+    # If several files have the same name, the one closest to the top of the tree is used
+    def scan(self):
+        files = {}
+        for root, dirnames, filenames in os.walk(self.directory):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if INDEX_RE.fullmatch(filename) or filename.endswith(ARCHIVE_SUFFIXES):
+                    files.setdefault(filename, os.path.join(root, filename))
+        self.files = files
+        self.last_scan = time.monotonic()
+
+    # returns file name for URL path, or None
+    def find(self, path):
+        name = urllib.parse.unquote(path.split('?', 1)[0]).lstrip('/')
+        if name not in self.files or not os.path.isfile(self.files[name]):
+            # build output may have changed since the last scan
+            if time.monotonic() - self.last_scan < RESCAN_INTERVAL:
+                return(None)
+            self.scan()
+        return(self.files.get(name))
+
+    # returns SHA-256 based ETag of file; computed once for each version of the file
+    def file_etag(self, filename, st):
+        cached = self.etags.get(filename)
+        if cached and cached[:2] == (st.st_size, st.st_mtime_ns):
+            return(cached[2])
+        sha256 = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha256.update(chunk)
+        etag = f'"{sha256.hexdigest()}"'
+        self.etags[filename] = (st.st_size, st.st_mtime_ns, etag)
+        return(etag)
+
+    # returns (contents, ETag) of index file with URL of each archive this server has replaced
+    # by its URL on this server
+    def index_body(self, filename, st, base_url):
+        key = (filename, base_url)
+        cached = self.indexes.get(key)
+        if cached and cached[:2] == (st.st_size, st.st_mtime_ns):
+            return(cached[2:])
+        with open(filename, 'r', encoding = 'UTF-8') as indexfile:
+            index = json.load(indexfile)
+        for package in index.get('packages', []):
+            for platform in package.get('platforms', []):
+                archive = platform.get('archiveFileName')
+                if archive in self.files:
+                    platform['url'] = f"{base_url}/{urllib.parse.quote(archive)}"
+        body = json.dumps(index, indent = 2).encode('UTF-8')
+        etag = f'"{hashlib.sha256(body).hexdigest()}"'
+        self.indexes.pop(key, None)
+        while len(self.indexes) >= INDEX_CACHE_SIZE:
+            del self.indexes[next(iter(self.indexes))]
+        self.indexes[key] = (st.st_size, st.st_mtime_ns, body, etag)
+        return(body, etag)
+
+    # handles one connection; several requests can be sent over it (keep-alive)
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+                if not await self.respond(writer, head):
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    # sends response to one request; returns True if the connection can be used for the next one
+    async def respond(self, writer, head):
+        lines = head.decode('latin-1').split('\r\n')
+        request = lines[0].split()
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+        if len(request) != 3 or not request[2].startswith('HTTP/'):
+            await self.send_error(writer, HTTPStatus.BAD_REQUEST, lines[0])
+            return(False)
+        method, path, version = request
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection != 'close' and (version != 'HTTP/1.0' or connection == 'keep-alive')
+        if headers.get('content-length', '0') != '0' or 'transfer-encoding' in headers:
+            # request bodies are not expected, and not read
+            keep_alive = False
+        if method not in ('GET', 'HEAD'):
+            await self.send_error(writer, HTTPStatus.METHOD_NOT_ALLOWED, lines[0], {'Allow': 'GET, HEAD'})
+            return(False)
+        filename = self.find(path)
+        try:
+            st = os.stat(filename) if filename else None
+        except OSError:
+            st = None
+        if st is None:
+            await self.send_error(writer, HTTPStatus.NOT_FOUND, lines[0], keep_alive = keep_alive)
+            return(keep_alive)
+        response = {'Date': email.utils.formatdate(usegmt = True),
+                    'Last-Modified': email.utils.formatdate(st.st_mtime, usegmt = True),
+                    'Accept-Ranges': 'bytes',
+                    'Content-Type': CONTENT_TYPES.get(os.path.splitext(filename)[1], 'application/octet-stream')}
+        if not keep_alive:
+            response['Connection'] = 'close'
+        loop = asyncio.get_running_loop()
+        body = None
+        if filename.endswith('.json'):
+            # host names are case insensitive
+            base_url = f"http://{(headers.get('host') or f'{self.host}:{self.port}').lower()}"
+            body, etag = self.index_body(filename, st, base_url)
+            size = len(body)
+        else:
+            # hashing a large archive doesn't hold up other clients
+            etag = await loop.run_in_executor(None, self.file_etag, filename, st)
+            size = st.st_size
+        response['ETag'] = etag
+        if 'if-none-match' in headers and etag_matches(headers['if-none-match'], etag):
+            writer.write(response_head(HTTPStatus.NOT_MODIFIED, response))
+            await writer.drain()
+            self.log(writer, lines[0], HTTPStatus.NOT_MODIFIED, 0)
+            return(keep_alive)
+        start, end = 0, size
+        status = HTTPStatus.OK
+        if 'range' in headers and ('if-range' not in headers or etag_matches_strong(headers['if-range'], etag)):
+            try:
+                requested = parse_range(headers['range'], size)
+            except ValueError:
+                await self.send_error(writer, HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, lines[0],
+                                      {'Content-Range': f"bytes */{size}"}, keep_alive)
+                return(keep_alive)
+            if requested:
+                start, end = requested
+                status = HTTPStatus.PARTIAL_CONTENT
+                response['Content-Range'] = f"bytes {start}-{end - 1}/{size}"
+        response['Content-Length'] = str(end - start)
+        writer.write(response_head(status, response))
+        if method == 'GET' and end > start:
+            if body is not None:
+                writer.write(body[start:end])
+            else:
+                # headers must be sent before the file is handed to the OS
+                await writer.drain()
+                with open(filename, 'rb') as f:
+                    await loop.sendfile(writer.transport, f, start, end - start)
+        await writer.drain()
+        self.log(writer, lines[0], status, end - start if method == 'GET' else 0)
+        return(keep_alive)
+
+    async def send_error(self, writer, status, request_line, headers = None, keep_alive = False):
+        body = f"{status.value} {status.phrase}\n".encode('UTF-8')
+        response = dict(headers or {}, **{'Content-Type': 'text/plain', 'Content-Length': str(len(body))})
+        if not keep_alive:
+            response['Connection'] = 'close'
+        writer.write(response_head(status, response) + body)
+        await writer.drain()
+        self.log(writer, request_line, status, len(body))
+
+    def log(self, writer, request_line, status, size):
+        if not self.quiet:
+            peer = writer.get_extra_info('peername')
+            print(f"{peer[0] if peer else '-'} \"{request_line}\" {status.value} {size}")
+
+    # starts listening; with port 0, a free port is chosen and saved in self.port
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return(self.server)
+
+    async def serve_forever(self):
+        await self.start()
+        for filename in sorted(name for name in self.files if INDEX_RE.fullmatch(name)):
+            print(f"Serving http://{self.host}:{self.port}/{filename}")
+        async with self.server:
+            await self.server.serve_forever()
+
+    # serves until interrupted with Ctrl-C
+    def run(self):
+        try:
+            asyncio.run(self.serve_forever())
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Serve built package index and archives to Arduino IDE.')
+    parser.add_argument('directory', metavar = 'DIRECTORY', nargs = '?', default = 'build',
+                        help = 'directory with index files and package archives (default: build)')
+    parser.add_argument('--host', default = '0.0.0.0', help = 'address to listen on (default: all interfaces)')
+    parser.add_argument('--port', type = int, default = 8000, help = 'port to listen on (default: 8000)')
+    parser.add_argument('--quiet', action = 'store_true', help = 'do not log requests')
+    args = parser.parse_args()
+    if not os.path.isdir(args.directory):
+        print(f"Directory {args.directory} not found")
+        sys.exit(1)
+    MirrorServer(args.directory, args.host, args.port, args.quiet).run()
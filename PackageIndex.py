@@ -0,0 +1,175 @@
+"""
+Class to update package_<vendor>_index.json files
+* Author(s): Alexander Kirillov
+* Version: 4.0
+
+See structure specifications here: https://arduino.github.io/arduino-cli/0.35/package_index_json-specification/
+"""
+
+import os
+import re
+import json
+import tempfile
+
+# returns key for sorting version strings semantically, e.g. 4.0.10 comes after 4.0.9,
+# and 4.1.0-rc1 comes before 4.1.0
+def version_key(version):
+    release, _, prerelease = version.partition('-')
+    def parts(s):
+        return [(1, int(part), '') if part.isdigit() else (0, 0, part) for part in re.split(r'[.+]', s)]
+    return (parts(release), 0 if prerelease else 1, parts(prerelease))
+
+# returns permissions for a new version of filename, written to a temporary file first: those of the
+# existing file, or the usual ones for a new file (0666 minus umask). Files made by tempfile.mkstemp
+# are only readable by their owner, which isn't right for an index file served by a web server
+def file_mode(filename):
+    try:
+        return(os.stat(filename).st_mode & 0o7777)
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return(0o666 & ~umask)
+
+# used to find where values start and end in index file text
+decoder = json.JSONDecoder()
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+INDENT = re.compile(r'[ \t]*')
+
+# returns (spans, close) for JSON array or object starting at pos in text: spans are (start, end)
+# of array elements, or (key, start, end) of object member values; close is position of the
+# closing bracket
+def value_spans(text, pos):
+    is_object = text[pos] == '{'
+    spans = []
+    pos = WHITESPACE.match(text, pos + 1).end()
+    if text[pos] in ']}':
+        return(spans, pos)
+    while True:
+        if is_object:
+            key, pos = decoder.raw_decode(text, pos)
+            pos = WHITESPACE.match(text, WHITESPACE.match(text, pos).end() + 1).end()
+        end = decoder.raw_decode(text, pos)[1]
+        spans.append((key, pos, end) if is_object else (pos, end))
+        pos = WHITESPACE.match(text, end).end()
+        if text[pos] != ',':
+            return(spans, pos)
+        pos = WHITESPACE.match(text, pos + 1).end()
+
+# returns start of value of member key of JSON object starting at pos
+def member_start(text, pos, key):
+    return([start for name, start, end in value_spans(text, pos)[0] if name == key][0])
+
+# returns indentation of line which contains pos
+def line_indent(text, pos):
+    return(INDENT.match(text, text.rfind('\n', 0, pos) + 1).group())
+
+# returns obj as JSON text, indented to be placed on a line starting with indent
+def dump_at(obj, indent):
+    return(json.dumps(obj, indent = 2).replace('\n', '\n' + indent))
+
+# returns text with obj inserted as element number index of JSON array starting at pos
+def insert_value(text, pos, index, obj):
+    spans, close = value_spans(text, pos)
+    if not spans:
+        indent = line_indent(text, pos)
+        return(text[:pos + 1] + '\n' + indent + '  ' + dump_at(obj, indent + '  ') + '\n' + indent + text[close:])
+    if index < len(spans):
+        start = spans[index][0]
+        indent = line_indent(text, start)
+        return(text[:start] + dump_at(obj, indent) + ',\n' + indent + text[start:])
+    start, end = spans[-1]
+    indent = line_indent(text, start)
+    return(text[:end] + ',\n' + indent + dump_at(obj, indent) + text[end:])
+
+class PackageIndex:
+    # loads existing index file; if filename is None or the file doesn't exist, starts with empty index.
+    # Text of the file is kept, so that only entries which change are rewritten on save
+    def __init__(self, filename = None):
+        self.data = {"packages": []}
+        self.text = None
+        if filename is not None and os.path.exists(filename):
+            with open(filename, 'r', encoding = 'UTF-8') as indexfile:
+                self.text = indexfile.read()
+            self.data = json.loads(self.text)
+
+    # adds platform to the package with the same name as package_entry; package is created from
+    # package_entry if there is no such package yet. Platform replaces existing entry for the same
+    # architecture and version in place; new versions are inserted in version order. All other
+    # entries are kept as they are. Returns True if index was changed
+    def upsert_platform(self, package_entry, platform):
+        packages = self.data["packages"]
+        package_number = len(packages)
+        for i, existing_package in enumerate(packages):
+            if existing_package.get("name") == package_entry["name"]:
+                package_number = i
+        if package_number == len(packages):
+            packages.append(dict(package_entry, platforms = [platform]))
+            self.update_text(package_number, None, False)
+            return(True)
+        platforms = packages[package_number].setdefault("platforms", [])
+        key = self.platform_key(platform)
+        for i, existing_platform in enumerate(platforms):
+            if self.platform_key(existing_platform) == key:
+                if existing_platform == platform:
+                    return(False)
+                platforms[i] = platform
+                self.update_text(package_number, i, True)
+                return(True)
+        # list versions from oldest to newest
+        version = version_key(platform.get("version", ""))
+        index = len(platforms)
+        for i, existing_platform in enumerate(platforms):
+            if version_key(existing_platform.get("version", "")) > version:
+                index = i
+                break
+        platforms.insert(index, platform)
+        self.update_text(package_number, index, False)
+        return(True)
+
+    # platforms are identified by architecture and version
+    def platform_key(self, platform):
+        return((platform.get("architecture"), platform.get("version")))
+
+    # splices changed package or platform entry into index file text, leaving the rest of the text
+    # (e.g. hand-edited entries) as it is. If the text can't be updated this way, whole index is
+    # written out again
+    def update_text(self, package_number, platform_number, replace):
+        if self.text is None:
+            self.text = json.dumps(self.data, indent = 2)
+            return
+        package = self.data["packages"][package_number]
+        text = self.text
+        try:
+            packages_start = member_start(text, WHITESPACE.match(text).end(), "packages")
+            if platform_number is None:
+                text = insert_value(text, packages_start, package_number, package)
+            else:
+                package_start = value_spans(text, packages_start)[0][package_number][0]
+                platforms_start = member_start(text, package_start, "platforms")
+                platform = package["platforms"][platform_number]
+                if replace:
+                    start, end = value_spans(text, platforms_start)[0][platform_number]
+                    text = text[:start] + dump_at(platform, line_indent(text, start)) + text[end:]
+                else:
+                    text = insert_value(text, platforms_start, platform_number, platform)
+            if json.loads(text) != self.data:
+                raise ValueError("index text doesn't match index data")
+        except (ValueError, IndexError):
+            text = json.dumps(self.data, indent = 2)
+        self.text = text
+
+    # writes index to file. File is replaced atomically, and not touched at all if its contents
+    # wouldn't change. Returns True if file was written
+    def save(self, filename):
+        new_data = self.text if self.text is not None else json.dumps(self.data, indent = 2)
+        if os.path.exists(filename):
+            with open(filename, 'r', encoding = 'UTF-8') as indexfile:
+                if indexfile.read() == new_data:
+                    return(False)
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, temp_name = tempfile.mkstemp(dir = directory, suffix = '.tmp')
+        with os.fdopen(fd, 'w', encoding = 'UTF-8') as tempfile_obj:
+            tempfile_obj.write(new_data)
+        os.chmod(temp_name, file_mode(filename))
+        os.replace(temp_name, filename)
+        return(True)
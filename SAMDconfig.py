@@ -8,11 +8,53 @@ import os
 import shutil
 import configparser
 import subprocess
-import glob 
-from string import Template
 import hashlib
-import json 
+import sys
+import tempfile
+import tarfile
+import zipfile
+import io
+import filecmp
+import json
+import PackageIndex
+import Footprint
+import ConfigValidator
+import TemplateRenderer
+import Toolchain
+from TemplateRenderer import write_if_changed
 from datetime import date 
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows; cache statistics are then updated without a lock
+    fcntl = None
+
+# directory containing this tool: package template and bootloader sources are found here,
+# so that the tool can be run from any directory
+TOOL_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIR = f"{TOOL_DIR}/PACKAGE_TEMPLATE"
+BOOTLOADER_SRC_DIR = f"{TOOL_DIR}/uf2-samd21"
+# persistent caches are kept here, outside of build directory
+CACHE_DIR = os.environ.get('SAMD_BOARD_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'samd-custom-board'))
+
+# write-only file wrapper, computing SHA256 hash and size of everything written through it.
+# It deliberately has no seek(), so that zipfile and tarfile write archives strictly sequentially
+class HashingWriter:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return(self.fileobj.write(data))
+
+    def tell(self):
+        return(self.size)
+
+    def flush(self):
+        self.fileobj.flush()
 
 class SAMDconfig:
     # constructor
@@ -20,9 +62,19 @@ class SAMDconfig:
         # dictionary containign all config data 
         self.d = {}
         self.d['build_date'] = date.today().isoformat()
+        # variant.cpp and variant.h are looked up next to config file
+        self.data_directory = os.path.dirname(os.path.abspath(filename))
+        # GCC toolchain, found when needed
+        self.toolchain = None
         # read all values from main sections of config file 
         config_file = configparser.ConfigParser()
         config_file.read(filename)    
+        # check all values at once, see ConfigValidator.py
+        errors = ConfigValidator.check_values(config_file)
+        if errors:
+            for error in errors:
+                print(f"{filename}: {error}")
+            raise RuntimeError(f"Invalid configuration file {filename}: {len(errors)} error(s)")
         for s in ['hardware', 'usb','names', 'paths']:
             for key, value in config_file[s].items():
                 self.d[key]=value
@@ -33,17 +85,13 @@ class SAMDconfig:
             for key, value in config_file[s].items():
                 self.extras[key]=value
 
-
-        #check for empty values
-        self.check_missing_values(self.d)
-        self.check_missing_values(self.extras)
-
         #define common properties 
         self.name = self.d['board_name']
         self.version = self.d['package_version']
         self.chip_family = self.d['chip_family']
         self.chip_variant = self.d['chip_variant']
         self.is_samd51 = (self.d['chip_family'] == 'SAMD51') or (self.d['chip_family'] == 'SAME51')
+        self.crystalless = ConfigValidator.parse_bool(self.d['crystalless'])
 
         # add MCU-specific parameters
         if self.chip_family == 'SAMD21':
@@ -71,57 +119,94 @@ class SAMDconfig:
 
         # add extra GCC  flags
         self.d['extra_flags'] += f' -D__{self.chip_variant}__'
-        if self.d['crystalless']:
+        if self.crystalless:
             self.d['extra_flags'] += ' -DCRYSTALLESS'
 
-    def check_missing_values(self, dictionary):
-        for key, value in dictionary.items():
-            if (not value):
-                print(f'No value provided for {key}')
-                raise RuntimeError('Missing configuration parameters')
-            
     # reads template file, does all substitutions from the dictionary, saves result as destination
-    # source and destination shoudl be filenames 
+    # source and destination shoudl be filenames. Destination is only written if it changes
     def process_file(self, source, destination):
+        return(self.renderer.render(source, destination, self.d))
 
-        with open(source, 'r', encoding = 'UTF-8') as template_file:
-            original  =template_file.read()
-            
-        new_data = Template(original).substitute(self.d)
-        with open(destination, "w", encoding = 'UTF-8') as dest_file: 
-            dest_file.write(new_data)
+    # creates build directory, containing package directory and bootloader build tree
+    # only the per-board files and the selected variant template are written to the build
+    # directory; bootloader sources are symlinked from uf2-samd21 unless link_sources is False.
+    # If clean is False, build directory from previous run is kept, and only files that
+    # changed are copied, so timestamps of unchanged files are kept. Returns number of bytes copied
+    def setup_build_directory(self, dirname, link_sources = True, clean = True):
+        copied = self.setup_bootloader_directory(dirname, link_sources, clean)
+        copied += self.setup_package_directory()
+        return(copied)
 
-    def setup_build_directory(self, dirname):
+    # first part of setup_build_directory: removes old build directory (if clean is True) and
+    # creates bootloader build tree. Returns number of bytes copied
+    def setup_bootloader_directory(self, dirname, link_sources = True, clean = True):
         self.build_directory = dirname
         self.package_directory = f"{dirname}/{self.version}"
-        if os.path.exists(dirname):
+        if clean and os.path.exists(dirname):
             print("Removing old build directory")
             shutil.rmtree(dirname)
-        shutil.copytree('PACKAGE_TEMPLATE',self.package_directory)
-        shutil.copytree('uf2-samd21', f'{self.build_directory}/uf2-samd21')
-        # now, select which board template to use - thye have different link scripts
-        variants_dir = self.package_directory+"/variants"
-        board_variant = f"{variants_dir}/{self.name}"
-        if self.chip_family == 'SAMD21':
-            # rename one of template directories and delete two others
-            shutil.move(variants_dir+'/TEMPLATE_SAMD21', board_variant)
-            shutil.rmtree(variants_dir+'/TEMPLATE_SAMD51')
-            shutil.rmtree(variants_dir+'/TEMPLATE_SAMD51P20A')
+        self.renderer = TemplateRenderer.TemplateRenderer(f"{dirname}/render_state.json")
+        if not os.path.exists(f"{dirname}/uf2-samd21"):
+            return(self.setup_bootloader_sources(f"{dirname}/uf2-samd21", link_sources))
+        return(0)
 
+    # second part of setup_build_directory: copies package template and variant files into package
+    # directory. Bootloader build tree isn't touched, so this can run while make builds the bootloader.
+    # Returns number of bytes copied
+    def setup_package_directory(self):
+        # copy package template, except variant templates and templates rendered by write_boards_txt
+        copied = sync_tree(TEMPLATE_DIR, self.package_directory,
+                           ignore = shutil.ignore_patterns('variants', '.DS_Store', '*_TEMPLATE*'))
+        # now, select which board template to use - they have different link scripts
+        if self.chip_family == 'SAMD21':
+            variant_template = 'TEMPLATE_SAMD21'
         elif self.chip_variant == 'SAMD51P20A':
-            shutil.move(variants_dir+'/TEMPLATE_SAMD51P20A', board_variant)
-            shutil.rmtree(variants_dir+'/TEMPLATE_SAMD51')
-            shutil.rmtree(variants_dir+'/TEMPLATE_SAMD21')
+            variant_template = 'TEMPLATE_SAMD51P20A'
         else:
             #SAMD51, but not SAMD51P20A
-            shutil.move(variants_dir+'/TEMPLATE_SAMD51', board_variant)
-            shutil.rmtree(variants_dir+'/TEMPLATE_SAMD21')
-            shutil.rmtree(variants_dir+'/TEMPLATE_SAMD51P20A')
+            variant_template = 'TEMPLATE_SAMD51'
+        copied += sync_tree(f"{TEMPLATE_DIR}/variants/{variant_template}", self.variant_directory(),
+                            ignore = shutil.ignore_patterns('.DS_Store'))
+        copied += self.copy_variant_files()
+        return(copied)
+
+    # package directory of the board variant
+    def variant_directory(self):
+        return(f"{self.package_directory}/variants/{self.name}")
+
+    # copies variant.cpp and variant.h from data directory into the package, if they changed.
+    # Returns number of bytes copied
+    def copy_variant_files(self):
+        copied = 0
+        for filename in ['variant.cpp', 'variant.h']:
+            copied += sync_file(f"{self.data_directory}/{filename}", f"{self.variant_directory()}/{filename}")
+        return(copied)
 
-        shutil.copy2('board_data/variant.cpp', board_variant)
-        shutil.copy2('board_data/variant.h', board_variant)
+    # creates bootloader build tree in given directory. Sources, headers and lib/ are used in place
+    # through symlinks; only boards/ (and later, build/) are real directories, so that
+    # per-board config files and build products never end up in uf2-samd21.
+    # Returns number of bytes copied (0 if everything was symlinked)
+    def setup_bootloader_sources(self, dest_directory, link_sources = True):
+        os.makedirs(f"{dest_directory}/boards")
+        copied = 0
+        for entry in os.listdir(BOOTLOADER_SRC_DIR):
+            if entry in ('boards', 'build', '.DS_Store'):
+                continue
+            source = f"{BOOTLOADER_SRC_DIR}/{entry}"
+            destination = f"{dest_directory}/{entry}"
+            if link_sources:
+                try:
+                    os.symlink(source, destination, target_is_directory = os.path.isdir(source))
+                    continue
+                except OSError:
+                    # e.g. Windows without developer mode; fall back to copying
+                    print("Can't create symlinks, copying bootloader sources instead")
+                    link_sources = False
+            copied += sync_tree(source, destination) if os.path.isdir(source) else sync_file(source, destination)
+        return(copied)
 
-    # creates boards.txt, platform.txt and README.md files, by processing template files in package directory 
+    # creates boards.txt, platform.txt and README.md files, by processing template files from
+    # package template. Files are only rendered again if config values they use have changed
     def write_boards_txt(self):
         # if necessary, add entries for cache and speed menus 
         self.d['menu_cache']=''
@@ -129,153 +214,300 @@ class SAMDconfig:
         if self.is_samd51:
             # cache menu 
             cache_prefix = f"{self.name}.menu.cache"
-            self.d['menu_cache']+= f"{cache_prefix}.on = Enabled\n"
-            self.d['menu_cache']+= f"{cache_prefix}.on.build.cache_flags=-DENABLE_CACHE\n"
-            self.d['menu_cache']+= f"{cache_prefix}.off=Disabled\n"
-            self.d['menu_cache']+= f"{cache_prefix}.off.build.cache_flags=\n"
+            self.d['menu_cache'] = "".join([
+                f"{cache_prefix}.on = Enabled\n",
+                f"{cache_prefix}.on.build.cache_flags=-DENABLE_CACHE\n",
+                f"{cache_prefix}.off=Disabled\n",
+                f"{cache_prefix}.off.build.cache_flags=\n"])
             # speed menu 
             speed_prefix = f"{self.name}.menu.speed"
-            self.d['menu_speed']+= f"{speed_prefix}.120=120 MHz (standard)\n"
-            self.d['menu_speed']+= f"{speed_prefix}.120.build.f_cpu=120000000L\n"
-            self.d['menu_speed']+= f"{speed_prefix}.150=150 MHz (overclock)\n"
-            self.d['menu_speed']+= f"{speed_prefix}.150.build.f_cpu=150000000L\n"
-            self.d['menu_speed']+= f"{speed_prefix}.180=180 MHz (overclock)\n"
-            self.d['menu_speed']+= f"{speed_prefix}.180.build.f_cpu=180000000L\n"
-            self.d['menu_speed']+= f"{speed_prefix}.200=200 MHz (overclock)\n"
-            self.d['menu_speed']+= f"{speed_prefix}.200.build.f_cpu=200000000L\n"
+            speed_entries = []
+            for speed, description in [(120, 'standard'), (150, 'overclock'), (180, 'overclock'), (200, 'overclock')]:
+                speed_entries.append(f"{speed_prefix}.{speed}={speed} MHz ({description})\n")
+                speed_entries.append(f"{speed_prefix}.{speed}.build.f_cpu={speed}000000L\n")
+            self.d['menu_speed'] = "".join(speed_entries)
         
-        # substitute all values in the template board.txt file
-        self.process_file(f"{self.package_directory}/boards_TEMPLATE.txt", f"{self.package_directory}/boards.txt")
-        os.remove(f"{self.package_directory}/boards_TEMPLATE.txt")       
-        # substitute all values in the template platfotm.txt file
-        self.process_file(f"{self.package_directory}/platform_TEMPLATE.txt", f"{self.package_directory}/platform.txt")
-        os.remove(f"{self.package_directory}/platform_TEMPLATE.txt")
-        self.process_file(f"{self.package_directory}/README_TEMPLATE.md", f"{self.package_directory}/README.md")
-        os.remove(f"{self.package_directory}/README_TEMPLATE.md")
+        # substitute all values in the template board.txt, platform.txt and README files
+        for template_name, output_name in [('boards_TEMPLATE.txt', 'boards.txt'),
+                                           ('platform_TEMPLATE.txt', 'platform.txt'),
+                                           ('README_TEMPLATE.md', 'README.md')]:
+            self.process_file(f"{TEMPLATE_DIR}/{template_name}", f"{self.package_directory}/{output_name}")
+        self.renderer.save_state()
        
-    # creates board.mk file in given directory
+    # creates board.mk file in given directory; file is only written if it changes, so make
+    # doesn't rebuild bootloader needlessly. Returns True if file was written
     def write_board_mk(self, dest_directory):
-        with open(f"{dest_directory}/board.mk", 'w', encoding = 'UTF-8') as board_mk:
-            board_mk.write("CHIP_FAMILY = "+ self.d['chip_family'].lower()+"\n")
-            board_mk.write("CHIP_VARIANT = "+self.d['chip_variant']+"\n")
+        return(write_if_changed(f"{dest_directory}/board.mk",
+                                "CHIP_FAMILY = "+ self.d['chip_family'].lower()+"\n" +
+                                "CHIP_VARIANT = "+self.d['chip_variant']+"\n"))
 
-    #creates board_config.h gile in given directory 
+    #creates board_config.h gile in given directory; returns True if file was written
     def write_board_config(self, dest_directory):
-        with open(f"{dest_directory}/board_config.h", 'w', encoding = 'UTF-8') as board_config:
-            board_config.write("#ifndef BOARD_CONFIG_H\n")
-            board_config.write("#define BOARD_CONFIG_H\n\n")
-            board_config.write('#define VENDOR_NAME      "'+self.d['vendor_name_long']+'"\n')
-            board_config.write('#define PRODUCT_NAME     "'+self.d['board_name_long']+'"\n')
-            board_config.write('#define VOLUME_LABEL     "'+self.d['volume_label']+'"\n')
-            board_config.write('#define INDEX_URL        "'+self.d['info_url']+'"\n\n')
-            board_config.write('#define USB_VID          '+self.d['usb_vid']+'\n')
-            board_config.write('#define USB_PID          '+self.d['usb_pid']+'\n')
-            board_id = self.chip_variant+"-"+self.d['board_define_name']+"-v0"
-            board_config.write('#define BOARD_ID         "'+board_id+'"\n\n')
-            if self.d['crystalless']:
-                board_config.write('#define CRYSTALLESS      1\n\n')
-            if 'led_pin' in self.d:
-                board_config.write('#define LED_PIN          '+self.d['led_pin']+'\n\n')
-            if 'board_neopixel_pin' in self.d:
-                board_config.write('#define BOARD_NEOPIXEL_PIN   '+self.d['board_neopixel_pin']+'\n')
-                board_config.write('#define BOARD_NEOPIXEL_COUNT   '+self.d['board_neopixel_count']+'\n\n')
-            if 'board_rgbled_clock_pin' in self.d:
-                board_config.write('#define BOARD_RGBLED_CLOCK_PIN   '+self.d['board_rgbled_clock_pin']+'\n')
-                board_config.write('#define BOARD_RGBLED_DATA_PIN   '+self.d['board_rgbled_data_pin']+'\n\n')
-
-            # now, add extras 
-
-            for key, value in self.extras.items():
-                padded_key=key.ljust(27).upper()
-                board_config.write(f'#define {padded_key} {value}\n')
-            board_config.write("#endif\n")
+        board_config = io.StringIO()
+        board_config.write("#ifndef BOARD_CONFIG_H\n")
+        board_config.write("#define BOARD_CONFIG_H\n\n")
+        board_config.write('#define VENDOR_NAME      "'+self.d['vendor_name_long']+'"\n')
+        board_config.write('#define PRODUCT_NAME     "'+self.d['board_name_long']+'"\n')
+        board_config.write('#define VOLUME_LABEL     "'+self.d['volume_label']+'"\n')
+        board_config.write('#define INDEX_URL        "'+self.d['info_url']+'"\n\n')
+        board_config.write('#define USB_VID          '+self.d['usb_vid']+'\n')
+        board_config.write('#define USB_PID          '+self.d['usb_pid']+'\n')
+        board_id = self.chip_variant+"-"+self.d['board_define_name']+"-v0"
+        board_config.write('#define BOARD_ID         "'+board_id+'"\n\n')
+        if self.crystalless:
+            board_config.write('#define CRYSTALLESS      1\n\n')
+        if 'led_pin' in self.d:
+            board_config.write('#define LED_PIN          '+self.d['led_pin']+'\n\n')
+        if 'board_neopixel_pin' in self.d:
+            board_config.write('#define BOARD_NEOPIXEL_PIN   '+self.d['board_neopixel_pin']+'\n')
+            board_config.write('#define BOARD_NEOPIXEL_COUNT   '+self.d['board_neopixel_count']+'\n\n')
+        if 'board_rgbled_clock_pin' in self.d:
+            board_config.write('#define BOARD_RGBLED_CLOCK_PIN   '+self.d['board_rgbled_clock_pin']+'\n')
+            board_config.write('#define BOARD_RGBLED_DATA_PIN   '+self.d['board_rgbled_data_pin']+'\n\n')
+
+        # now, add extras 
+
+        for key, value in self.extras.items():
+            padded_key=key.ljust(27).upper()
+            board_config.write(f'#define {padded_key} {value}\n')
+        board_config.write("#endif\n")
+        return(write_if_changed(f"{dest_directory}/board_config.h", board_config.getvalue()))
+
+    # finds GCC included with Adafruit SAMD package: latest version, or the one given by
+    # GCC_VERSION in config file. Result is cached, see Toolchain.py
+    def resolve_toolchain(self):
+        if self.toolchain is None:
+            gcc_tool_path = os.path.expanduser('~')+"/"+self.d['arduino15']+"/packages/adafruit/tools/arm-none-eabi-gcc"
+            # e.g. /Users/shurik/Library/Arduino15/packages/adafruit/tools/arm-none-eabi-gcc
+            self.toolchain = Toolchain.Toolchain(gcc_tool_path, self.d.get('gcc_version'),
+                                                 f"{CACHE_DIR}/toolchain.json").resolve()
+        return(self.toolchain)
+
+    # returns bin directory of GCC
+    def find_gcc(self):
+        return(self.resolve_toolchain().bin_path)
 
     # gets all necessary paths for GCC and make and adds them to PATH
     # returns environment with these paths
     def get_paths(self):
         new_env = os.environ.copy()
-        # find GCC included with Adafruit SAMD package
-        gcc_tool_path = new_env['HOME']+"/"+self.d['arduino15']+"/packages/adafruit/tools/arm-none-eabi-gcc"
-        # e.g. /Users/shurik/Library/Arduino15/packages/adafruit/tools/arm-none-eabi-gcc
-        if not os.path.exists(gcc_tool_path):
-            raise RuntimeError("Couldn't find arm-none-eabi-gcc. Make sure you have installed Adafruit SAMD boards package!")
-        # now look for latest version.
-        # we do not use just listdir since we want to make sure we do not include dotfiles
-        gcc_versions = sorted(glob.glob(gcc_tool_path+"/*"))
-        last_gcc_version = gcc_versions[-1]
-        gcc_path = f"{last_gcc_version}/bin"
-        print(f"Found GCC compiler at {gcc_path}")
-        # add the paths to PATH env variable
+        gcc_path = self.find_gcc()
+        print(f"Found GCC compiler at {gcc_path} ({self.toolchain.gcc_version})")
+        # add the paths in front of PATH env variable, so that they take precedence over other
+        # installed compilers
         if 'make_path' in self.d:
-            new_env["PATH"] = os.pathsep.join([new_env["PATH"], gcc_path, self.d['make_path']])
+            new_env["PATH"] = os.pathsep.join([gcc_path, self.d['make_path'], new_env["PATH"]])
         else:
-            new_env["PATH"] = os.pathsep.join([new_env["PATH"], gcc_path])
+            new_env["PATH"] = os.pathsep.join([gcc_path, new_env["PATH"]])
         return(new_env)
 
-    def build_bootloader(self):
+    # returns list of files and directories in uf2-samd21 the bootloader is built from;
+    # library include directories are selected the same way as in the Makefile
+    def bootloader_sources(self):
+        sources = ['Makefile', 'src', 'inc', 'scripts', 'lib/cmsis/CMSIS/Include', 'lib/usb_msc', 'lib/uf2/utils']
+        if self.chip_family == 'SAMD21':
+            sources.append('lib/samd21/samd21a/include')
+        elif 'SAME51' in self.chip_variant:
+            sources.append('lib/same51/include')
+        elif 'SAME54' in self.chip_variant:
+            sources.append('lib/same54/include')
+        else:
+            sources.append('lib/samd51/include')
+        return(sources)
+
+    # computes hash of everything that affects the bootloader binary: generated board.mk and
+    # board_config.h, bootloader sources, version string passed to make and the toolchain version
+    def bootloader_key(self):
+        key = hashlib.sha256()
+        key.update(f"toolchain:{self.resolve_toolchain().identity()}\n".encode('UTF-8'))
+        key.update(f"version:{self.version}\n".encode('UTF-8'))
+        for config_file in ['board.mk', 'board_config.h']:
+            with open(f"{self.build_directory}/uf2-samd21/boards/{self.name}/{config_file}", 'rb') as f:
+                key.update(f.read())
+        for source in self.bootloader_sources():
+            source_path = f"{BOOTLOADER_SRC_DIR}/{source}"
+            if os.path.isfile(source_path):
+                files = [source_path]
+            else:
+                files = sorted(os.path.join(root, name) for root, dirs, names in os.walk(source_path)
+                               for name in names if name != '.DS_Store')
+            for filename in files:
+                key.update(os.path.relpath(filename, BOOTLOADER_SRC_DIR).replace(os.sep, '/').encode('UTF-8') + b'\0')
+                with open(filename, 'rb') as f:
+                    key.update(f.read())
+        return(key.hexdigest())
+
+    # returns (hits, misses) counts of bootloader artifact cache
+    def artifact_cache_stats(self):
+        stats = load_cache_stats()
+        return(stats['hit'], stats['miss'])
+
+    # records cache hit or miss in stats.json. Counters are updated under a lock where the OS
+    # supports it, since several builds can run at the same time
+    def record_artifact_cache_result(self, result):
+        os.makedirs(f"{CACHE_DIR}/artifacts", exist_ok = True)
+        with open(f"{CACHE_DIR}/artifacts/stats.lock", 'w') as lockfile:
+            if fcntl:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+            stats = load_cache_stats()
+            stats[result] = stats.get(result, 0) + 1
+            fd, temp_name = tempfile.mkstemp(dir = f"{CACHE_DIR}/artifacts", suffix = '.tmp')
+            with os.fdopen(fd, 'w', encoding = 'UTF-8') as statsfile:
+                json.dump(stats, statsfile)
+            os.replace(temp_name, f"{CACHE_DIR}/artifacts/stats.json")
+
+    # name of bootloader files built by make, without extension; known before make is run
+    def bootloader_basename(self):
+        return(f"bootloader-{self.name}-{self.version}")
+
+    # builds bootloader in the build directory. Doesn't change current directory, so that
+    # several boards can be built at the same time.
+    # jobs is the number of parallel make jobs (default: number of CPUs); if object_cache is True,
+    # compiled objects are reused between builds, see objcache.py
+    # if artifact_cache is True, and a bootloader with the same inputs was built before, it is
+    # reused and make is not run at all
+    def build_bootloader(self, jobs = None, object_cache = True, artifact_cache = True):
+        bootloader_build_dir = f"{self.build_directory}/uf2-samd21"
+        bootloader_dir = f"{bootloader_build_dir}/build/{self.name}"
+        bootloader_basename = self.bootloader_basename()
+        # files produced by make, as (cached name, built name)
+        artifacts = [(f"bootloader.{ext}", f"{bootloader_basename}.{ext}") for ext in ['bin', 'elf', 'map']]
+        artifacts += [(f"update-bootloader.{ext}", f"update-{bootloader_basename}.{ext}") for ext in ['bin', 'uf2', 'ino']]
+        if artifact_cache:
+            key = self.bootloader_key()
+            cached_dir = f"{CACHE_DIR}/artifacts/{key[:2]}/{key}"
+            if os.path.isdir(cached_dir):
+                self.record_artifact_cache_result('hit')
+                os.makedirs(bootloader_dir, exist_ok = True)
+                for cached_name, built_name in artifacts:
+                    shutil.copy2(f"{cached_dir}/{cached_name}", f"{bootloader_dir}/{built_name}")
+                hits, misses = self.artifact_cache_stats()
+                print(f"Bootloader cache hit ({key[:12]}), not running make. Cache stats: {hits} hits, {misses} misses")
+                return(bootloader_dir,bootloader_basename)
+
         # first, get paths 
         new_env = self.get_paths()
-        os.chdir('build/uf2-samd21')
+        make_path = shutil.which('make', path = new_env['PATH'])
+        if make_path is None:
+            raise RuntimeError("Couldn't find GNU make. Please check MAKE_PATH in config file")
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        command = [make_path, f"-j{jobs}", f"BOARD={self.name}", f"VERSION={self.version}"]
+        if object_cache:
+            new_env['SAMD_COMPILER_ID'] = self.toolchain.identity()
+            new_env['SAMD_OBJECT_CACHE'] = f"{CACHE_DIR}/objects"
+            command.append(f'CC="{sys.executable}" "{TOOL_DIR}/objcache.py" arm-none-eabi-gcc')
         # run make to build bootloader
-        print("Starting GNU make...")
-        with open('bootloader_build_log.txt', 'w', encoding = 'UTF-8') as logfile:
-            command = f"make BOARD={self.name} VERSION={self.version}"
-            make_process = subprocess.run(command, shell = True, env=new_env, stdout=logfile,text=True)
-            if (make_process.returncode):
-                print("Making bootloader failed. Please see the log file for details")
-            else:
-                print("Successfully built bootloader")
-        
-        # copy built bootloader
-        os.chdir("../..")
-        bootloader_dir = f"{self.build_directory}/uf2-samd21/build/{self.name}"
-        bootloader_basename = f"bootloader-{self.name}-{self.version}"
+        # compiler errors go to the log file, too
+        print(f"Starting GNU make ({jobs} jobs)...")
+        log_filename = f"{bootloader_build_dir}/bootloader_build_log.txt"
+        with open(log_filename, 'w', encoding = 'UTF-8') as logfile:
+            make_process = subprocess.run(command, env=new_env, stdout=logfile, stderr=subprocess.STDOUT,
+                                          text=True, cwd = bootloader_build_dir)
+        if (make_process.returncode):
+            with open(log_filename, 'r', encoding = 'UTF-8', errors = 'replace') as logfile:
+                log_tail = logfile.readlines()[-20:]
+            raise RuntimeError(f"Making bootloader failed (make exit status {make_process.returncode}). "
+                               f"Last lines of {log_filename}:\n" + "".join(log_tail))
+        print("Successfully built bootloader")
+
+        if artifact_cache:
+            self.record_artifact_cache_result('miss')
+            # store artifacts; copy to temporary directory first so that partial entries are never used
+            os.makedirs(os.path.dirname(cached_dir), exist_ok = True)
+            temp_dir = tempfile.mkdtemp(dir = os.path.dirname(cached_dir))
+            for cached_name, built_name in artifacts:
+                shutil.copy2(f"{bootloader_dir}/{built_name}", f"{temp_dir}/{cached_name}")
+            try:
+                os.rename(temp_dir, cached_dir)
+            except OSError:
+                # the same bootloader was stored by another build in the meantime
+                shutil.rmtree(temp_dir)
+            hits, misses = self.artifact_cache_stats()
+            print(f"Stored bootloader in cache ({key[:12]}). Cache stats: {hits} hits, {misses} misses")
         return(bootloader_dir,bootloader_basename)
     
-    # compress already constructed package directory into a zip archive and 
-    # record archive size and SHA256 checksum
-    def package_archive(self):
-        zip_archive = shutil.make_archive(f"{self.build_directory}/{self.name}-{self.version}", 
-                                  'zip', 
-                                  root_dir = self.build_directory,
-                                  base_dir=self.version)
-        archive_size = os.path.getsize(zip_archive)
-        # compute hash:
-        with open(zip_archive, "rb") as f:
-            bytes = f.read() # read entire file as bytes
-            hash = hashlib.sha256(bytes).hexdigest()
-    
-        print(f"Created package archive, size {archive_size} bytes,\n SHA256 hash: {hash}")
+    # reports flash and RAM usage of built bootloader, and records it in footprint history file
+    # (unless record_history is False). Raises RuntimeError if the bootloader doesn't fit
+    def check_footprint(self, bootloader_dir, bootloader_basename, record_history = True):
+        # bootloader occupies flash below the application start address
+        footprint = Footprint.Footprint(f"{bootloader_dir}/{bootloader_basename}.map",
+                                        f"{bootloader_dir}/{bootloader_basename}.elf",
+                                        flash_budget = int(self.d['offset'], 0))
+        footprint.print_report()
+        self.footprint = footprint
+        if record_history:
+            previous = Footprint.record_history(self.footprint_history_file(), self.name, self.version, footprint)
+            if previous is not None:
+                print(f"Change since version {previous['version']}: flash {footprint.flash - previous['flash']:+} bytes, "
+                      f"RAM {footprint.ram - previous['ram']:+} bytes")
+        if footprint.over_budget():
+            raise RuntimeError(f"Bootloader doesn't fit: uses {footprint.flash} bytes of flash "
+                               f"(available: {footprint.flash_budget}) and {footprint.ram} bytes of RAM "
+                               f"(available: {footprint.ram_budget})")
+        return(footprint)
+
+    # returns path of footprint history file, given by FOOTPRINT_HISTORY in config file (relative to
+    # config file directory); by default, it is kept in cache directory
+    def footprint_history_file(self):
+        if 'footprint_history' not in self.d:
+            return(f"{CACHE_DIR}/footprint_history.json")
+        return(os.path.join(self.data_directory, self.d['footprint_history']))
+
+    # compress already constructed package directory into archive(s) and 
+    # record archive size and SHA256 checksum. Supported formats are 'zip', 'tar.gz' and 'tar.bz2';
+    # size and checksum of the first one are used for json index file
+    def package_archive(self, formats = ('zip',), compresslevel = 9):
+        archives = []
+        for archive_format in formats:
+            archive_filename = f"{self.name}-{self.version}.{archive_format}"
+            archive_size, archive_checksum = write_archive(self.package_directory,
+                                                           f"{self.build_directory}/{archive_filename}",
+                                                           archive_format, compresslevel)
+            archives.append((archive_filename, archive_size, archive_checksum))
         # add the info to dictionary
-        self.d['archive_filename']=f"{self.name}-{self.version}.zip"
-        self.d['archive_size']= archive_size
-        self.d['archive_checksum']=hash 
+        self.d['archive_filename'], self.d['archive_size'], self.d['archive_checksum'] = archives[0]
+        return(archives)
+
+    # returns download URL of package archive (by default, of this board), built from PACKAGE_URL in config file
+    def archive_url(self, archive_filename = None):
+        archive_filename = archive_filename or self.d["archive_filename"]
+        if 'package_url' not in self.d:
+            print("Warning: PACKAGE_URL is not set in config file, index file will contain archive name instead of URL")
+            return(archive_filename)
+        return(self.d['package_url'].rstrip('/') + '/' + archive_filename)
+
+    # returns path of existing index file to update, given by PACKAGE_INDEX in config file
+    # (relative to config file directory), or None if not set
+    def package_index_file(self):
+        if 'package_index' not in self.d:
+            return(None)
+        return(os.path.join(self.data_directory, self.d['package_index']))
 
-    # write json index file 
-    def write_index_json(self):
+    # returns the platform entry for json index file: for this board's package, or for given
+    # archive (filename, size, checksum) containing given boards, see write_combined_package
+    def platform_entry(self, archive = None, boards = None):
         # see structure specifications here: https://arduino.github.io/arduino-cli/0.35/package_index_json-specification/
-        # let's create the current version of samd platform
-        samd_current={
+        archive_filename, archive_size, archive_checksum = archive or \
+            (self.d["archive_filename"], self.d["archive_size"], self.d["archive_checksum"])
+        return {
             "name": self.d["package_name"],
             "architecture": "samd",
             "version": self.d["package_version"],
             "category": "Contributed",
-            "url": "FIXME",
-            "archiveFileName": self.d["archive_filename"],
-            "checksum": "SHA-256:"+self.d["archive_checksum"],
-            "size": self.d["archive_size"],
-            "boards": [
-                {
-                    "name": self.d["board_name_long"]
-                }
-            ],
+            "url": self.archive_url(archive_filename),
+            "archiveFileName": archive_filename,
+            "checksum": "SHA-256:"+archive_checksum,
+            "size": archive_size,
+            "boards": [{"name": board.d["board_name_long"]} for board in (boards or [self])],
             "toolsDependencies":
             [
             ]
         }
 
-        # create the package structure
-        package = {
+    # returns the package (vendor) entry for json index file, containing given platforms
+    def package_entry(self, platforms):
+        return {
             "name": self.d["vendor_name"],
             "maintainer": self.d["vendor_name_long"],
             "websiteURL": self.d["info_url"],
@@ -283,16 +515,157 @@ class SAMDconfig:
                 "online": self.d["help_url"]
             },
             "email" : self.d["vendor_email"],
-            "platforms":[samd_current],
+            "platforms": platforms,
             "tools":[]
         }
-        # FIXME: deal wiht previous versions
-        packages = {"packages": [package]}
-        # now save to json 
-        indexfile_name = self.build_directory+"/package_"+self.d['vendor_name']+"_index.json"
-        with open(indexfile_name, 'w', encoding = 'UTF-8') as indexfile:
-            json.dump(packages,indexfile, indent = 2)
 
+    # write json index file. If PACKAGE_INDEX is given in config file, the current version is added
+    # to that index (previous versions are kept) and the file is updated in place, unless
+    # update_package_index is False. Updated index is also saved in the build directory
+    def write_index_json(self, update_package_index = True):
+        package_index_file = self.package_index_file() if update_package_index else None
+        index = PackageIndex.PackageIndex(package_index_file)
+        index.upsert_platform(self.package_entry([]), self.platform_entry())
+        index.save(self.build_directory+"/package_"+self.d['vendor_name']+"_index.json")
+        if package_index_file is not None:
+            if index.save(package_index_file):
+                print(f"Updated {package_index_file}")
+
+
+# returns {'hit': count, 'miss': count} of bootloader artifact cache
+def load_cache_stats():
+    stats = {'hit': 0, 'miss': 0}
+    try:
+        with open(f"{CACHE_DIR}/artifacts/stats.json", 'r', encoding = 'UTF-8') as statsfile:
+            stats.update(json.load(statsfile))
+    except (OSError, ValueError):
+        pass
+    return(stats)
+
+# copies file, unless destination already has the same contents. Returns number of bytes copied
+def sync_file(source, destination):
+    if os.path.exists(destination) and filecmp.cmp(source, destination, shallow = False):
+        return(0)
+    shutil.copy2(source, destination)
+    return(os.path.getsize(destination))
+
+# copies directory tree like shutil.copytree, but only files which are missing or differ
+# in destination. Returns number of bytes copied
+def sync_tree(source, destination, ignore = None):
+    copied = 0
+    names = os.listdir(source)
+    ignored = ignore(source, names) if ignore else set()
+    os.makedirs(destination, exist_ok = True)
+    for name in names:
+        if name in ignored:
+            continue
+        if os.path.isdir(f"{source}/{name}"):
+            copied += sync_tree(f"{source}/{name}", f"{destination}/{name}", ignore)
+        else:
+            copied += sync_file(f"{source}/{name}", f"{destination}/{name}")
+    return(copied)
+
+# writes package directory as archive of given format ('zip', 'tar.gz' or 'tar.bz2'); paths in the
+# archive start with the name of package directory (the version). Returns archive size and SHA256 checksum
+def write_archive(package_directory, archive_path, archive_format = 'zip', compresslevel = 9):
+    # size and checksum are computed while writing, archive is never read back
+    with open(archive_path, 'wb') as archive_file:
+        writer = HashingWriter(archive_file)
+        if archive_format == 'zip':
+            write_zip(package_directory, writer, compresslevel)
+        else:
+            with tarfile.open(fileobj = writer, mode = 'w:'+archive_format.split('.')[1],
+                              compresslevel = compresslevel) as tar:
+                tar.add(package_directory, arcname = os.path.basename(package_directory))
+    archive_checksum = writer.hash.hexdigest()
+    print(f"Created package archive {os.path.basename(archive_path)}, size {writer.size} bytes,\n SHA256 hash: {archive_checksum}")
+    return(writer.size, archive_checksum)
+
+# writes package directory as zip archive to given (not necessarily seekable) file object
+def write_zip(package_directory, fileobj, compresslevel):
+    top_directory = os.path.dirname(package_directory)
+    with zipfile.ZipFile(fileobj, 'w', compression = zipfile.ZIP_DEFLATED, compresslevel = compresslevel) as zip_archive:
+        for root, dirs, files in os.walk(package_directory):
+            dirs.sort()
+            arc_root = os.path.relpath(root, top_directory)
+            zip_archive.write(root, arc_root)
+            for filename in sorted(files):
+                zip_archive.write(os.path.join(root, filename), os.path.join(arc_root, filename))
+
+# checks that boards of each vendor can be combined into one package: they must share package name
+# and version, as Boards Manager installs one platform per architecture and version.
+# Raises RuntimeError otherwise
+def check_combinable(boards):
+    first_boards = {}
+    for board in boards:
+        first = first_boards.setdefault(board.d['vendor_name'], board)
+        if (board.d['package_name'], board.version) != (first.d['package_name'], first.version):
+            raise RuntimeError(f"Boards {first.name} and {board.name} of vendor {first.d['vendor_name']} "
+                               "must have the same PACKAGE_NAME and PACKAGE_VERSION to be packaged together")
+
+# combines packages of several boards of one vendor, built separately, into one package in
+# <dirname>/package_<vendor>: common files are taken from the first board, variants and bootloaders
+# from all boards, and boards.txt describes all boards. Boards must share package name and version
+# (see check_combinable). Returns list of (archive filename, size, checksum), one per format
+def write_combined_package(boards, dirname, formats = ('zip',), compresslevel = 9):
+    check_combinable(boards)
+    first = boards[0]
+    combined_directory = f"{dirname}/package_{first.d['vendor_name']}"
+    package_directory = f"{combined_directory}/{first.version}"
+    # boards may have been removed since last build, so nothing is kept
+    if os.path.exists(combined_directory):
+        shutil.rmtree(combined_directory)
+    sync_tree(first.package_directory, package_directory,
+              ignore = shutil.ignore_patterns('variants', 'bootloaders', 'boards.txt'))
+    for board in boards:
+        for subdirectory in ['variants', 'bootloaders']:
+            sync_tree(f"{board.package_directory}/{subdirectory}/{board.name}",
+                      f"{package_directory}/{subdirectory}/{board.name}")
+    write_merged_boards_txt(boards, f"{package_directory}/boards.txt")
+    archives = []
+    for archive_format in formats:
+        archive_filename = f"{first.d['vendor_name']}-{first.version}.{archive_format}"
+        archive_size, archive_checksum = write_archive(package_directory, f"{combined_directory}/{archive_filename}",
+                                                       archive_format, compresslevel)
+        archives.append((archive_filename, archive_size, archive_checksum))
+    return(archives)
 
+# write one json index file for several boards, built separately. Boards are grouped by vendor;
+# the boards of each vendor are combined into one package (see write_combined_package), listed as
+# a single platform in the vendor's index file. Index file starts from PACKAGE_INDEX of the first
+# board of that vendor, which is updated, too. Returns list of created files
+def write_merged_index_json(boards, dirname, formats = ('zip',), compresslevel = 9):
+    vendors = {}
+    for board in boards:
+        vendors.setdefault(board.d['vendor_name'], []).append(board)
+    index_files = []
+    for vendor_name, vendor_boards in vendors.items():
+        archives = write_combined_package(vendor_boards, dirname, formats, compresslevel)
+        first = vendor_boards[0]
+        package_index_file = first.package_index_file()
+        index = PackageIndex.PackageIndex(package_index_file)
+        index.upsert_platform(first.package_entry([]), first.platform_entry(archives[0], vendor_boards))
+        indexfile_name = f"{dirname}/package_{vendor_name}_index.json"
+        index.save(indexfile_name)
+        index_files.append(indexfile_name)
+        if package_index_file is not None:
+            if index.save(package_index_file):
+                print(f"Updated {package_index_file}")
+    return(index_files)
 
-    
\ No newline at end of file
+# write one boards.txt file describing several boards, built separately.
+# Menu definitions at the top are taken from the first board; then board sections of all boards follow
+def write_merged_boards_txt(boards, filename):
+    sections = []
+    header = None
+    for board in boards:
+        with open(f"{board.package_directory}/boards.txt", 'r', encoding = 'UTF-8') as boards_file:
+            content = boards_file.read()
+        # board section starts with a line of dashes, followed by board name
+        split_pos = content.find('# -----')
+        if header is None:
+            header = content[:split_pos]
+        sections.append(content[split_pos:])
+    with open(filename, 'w', encoding = 'UTF-8') as merged_file:
+        merged_file.write(header)
+        merged_file.write('\n'.join(sections))
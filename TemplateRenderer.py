@@ -0,0 +1,68 @@
+"""
+Class to render package template files (boards.txt, platform.txt, README.md)
+* Author(s): Alexander Kirillov
+* Version: 4.0
+"""
+
+import os
+import json
+from string import Template
+
+# writes text to file, unless the file already has exactly this content, so that
+# timestamps of unchanged files are kept. Returns True if file was written
+def write_if_changed(filename, text):
+    if os.path.exists(filename):
+        with open(filename, 'r', encoding = 'UTF-8') as existing_file:
+            if existing_file.read() == text:
+                return(False)
+    with open(filename, 'w', encoding = 'UTF-8') as dest_file:
+        dest_file.write(text)
+    return(True)
+
+class TemplateRenderer:
+    # state_file keeps, for each rendered file, the values of config keys it was rendered with,
+    # so that unchanged files are not even re-rendered in the next run
+    def __init__(self, state_file = None):
+        self.state_file = state_file
+        # parsed templates: source filename -> (mtime, Template, list of keys used)
+        self.templates = {}
+        # destination filename -> [template mtime, {key: value}]
+        self.rendered = {}
+        if state_file is not None and os.path.exists(state_file):
+            with open(state_file, 'r', encoding = 'UTF-8') as f:
+                self.rendered = json.load(f)
+
+    # returns (mtime, Template, keys) for given template file; each file is read and parsed only once,
+    # unless it is modified
+    def load(self, source):
+        mtime = os.stat(source).st_mtime
+        if source not in self.templates or self.templates[source][0] != mtime:
+            with open(source, 'r', encoding = 'UTF-8') as template_file:
+                template = Template(template_file.read())
+            keys = set()
+            for match in template.pattern.finditer(template.template):
+                key = match.group('named') or match.group('braced')
+                if key:
+                    keys.add(key)
+            self.templates[source] = (mtime, template, sorted(keys))
+        return(self.templates[source])
+
+    # renders template source with values from dictionary and saves result as destination, but only
+    # if any of the values used by the template (or the template itself) changed since last time.
+    # Returns True if destination was written
+    def render(self, source, destination, values):
+        mtime, template, keys = self.load(source)
+        used = {key: str(values[key]) for key in keys if key in values}
+        if self.rendered.get(destination) == [mtime, used] and os.path.exists(destination):
+            return(False)
+        changed = write_if_changed(destination, template.substitute(values))
+        self.rendered[destination] = [mtime, used]
+        return(changed)
+
+    # returns list of config keys used by given template
+    def keys(self, source):
+        return(self.load(source)[2])
+
+    def save_state(self):
+        if self.state_file is not None:
+            write_if_changed(self.state_file, json.dumps(self.rendered, indent = 2))
@@ -0,0 +1,88 @@
+"""
+Class to find arm-none-eabi-gcc toolchain included with Adafruit SAMD package
+* Author(s): Alexander Kirillov
+* Version: 4.0
+"""
+
+import os
+import re
+import json
+import glob
+import shutil
+import subprocess
+import tempfile
+
+# returns key for sorting toolchain version directory names, comparing numbers numerically,
+# so that e.g. 10.3.1 comes after 9-2019q4
+def version_key(version):
+    return [(0, int(part), '') if part.isdigit() else (1, 0, part) for part in re.findall(r'\d+|[A-Za-z]+', version)]
+
+class Toolchain:
+    # tools_dir is the directory containing toolchain versions, e.g.
+    # ~/Library/Arduino15/packages/adafruit/tools/arm-none-eabi-gcc; if version is given, that version
+    # is used instead of the latest one. Resolved toolchain is remembered in cache_file
+    def __init__(self, tools_dir, version = None, cache_file = None):
+        self.tools_dir = tools_dir
+        self.pinned_version = version
+        self.cache_file = cache_file
+        self.version = None
+        self.bin_path = None
+        self.gcc_version = None
+
+    # unique identity of the toolchain, e.g. for build cache keys
+    def identity(self):
+        return(f"{self.version}:{self.gcc_version}")
+
+    # fingerprint of the toolchain installation: changes if versions are added or removed,
+    # or the compiler is replaced
+    def fingerprint(self, bin_path):
+        fingerprint = [os.stat(self.tools_dir).st_mtime]
+        gcc = shutil.which('arm-none-eabi-gcc', path = bin_path)
+        if gcc is not None:
+            gcc_stat = os.stat(gcc)
+            fingerprint += [gcc_stat.st_mtime, gcc_stat.st_size]
+        return(fingerprint)
+
+    def cache_key(self):
+        return(f"{self.tools_dir}:{self.pinned_version or 'latest'}")
+
+    # finds the toolchain. If it was found before and the installation didn't change, the cached
+    # result is used; otherwise versions are sorted and compiler is asked for its version once
+    def resolve(self):
+        if not os.path.exists(self.tools_dir):
+            raise RuntimeError("Couldn't find arm-none-eabi-gcc. Make sure you have installed Adafruit SAMD boards package!")
+        cache = {}
+        if self.cache_file is not None and os.path.exists(self.cache_file):
+            with open(self.cache_file, 'r', encoding = 'UTF-8') as f:
+                cache = json.load(f)
+        entry = cache.get(self.cache_key())
+        if entry is not None and os.path.isdir(entry['bin_path']) and \
+           entry['fingerprint'] == self.fingerprint(entry['bin_path']):
+            self.version, self.bin_path, self.gcc_version = entry['version'], entry['bin_path'], entry['gcc_version']
+            return(self)
+
+        # we do not use just listdir since we want to make sure we do not include dotfiles
+        versions = [os.path.basename(path) for path in glob.glob(self.tools_dir+"/*")]
+        if self.pinned_version is not None:
+            if self.pinned_version not in versions:
+                raise RuntimeError(f"Couldn't find arm-none-eabi-gcc version {self.pinned_version}; "
+                                   f"available versions: {', '.join(sorted(versions, key = version_key))}")
+            self.version = self.pinned_version
+        else:
+            self.version = sorted(versions, key = version_key)[-1]
+        self.bin_path = f"{self.tools_dir}/{self.version}/bin"
+        gcc = shutil.which('arm-none-eabi-gcc', path = self.bin_path)
+        if gcc is None:
+            raise RuntimeError(f"Couldn't find arm-none-eabi-gcc in {self.bin_path}")
+        self.gcc_version = subprocess.run([gcc, '--version'], stdout = subprocess.PIPE,
+                                          text = True).stdout.splitlines()[0]
+        cache[self.cache_key()] = {'version': self.version, 'bin_path': self.bin_path,
+                                   'gcc_version': self.gcc_version,
+                                   'fingerprint': self.fingerprint(self.bin_path)}
+        if self.cache_file is not None:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok = True)
+            fd, temp_name = tempfile.mkstemp(dir = os.path.dirname(self.cache_file))
+            with os.fdopen(fd, 'w', encoding = 'UTF-8') as f:
+                json.dump(cache, f, indent = 2)
+            os.replace(temp_name, self.cache_file)
+        return(self)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for uf2conv.py, gendata.py and the makeboard.py pipeline
+* Author(s): Alexander Kirillov
+* Version: 4.0
+
+Usage: benchmark.py [--update] [--quick] [--tolerance X] [--only NAME]
+
+Generates synthetic BIN/HEX/UF2 inputs, times each conversion (best of several runs),
+measures peak memory with tracemalloc and compares results against baselines.json.
+The full makeboard.py pipeline is run against stub make/arm-none-eabi-gcc in a temporary
+ARDUINO15 tree, so no toolchain or network is needed. Exits with non-zero status if any
+benchmark is slower, or uses more memory, than its baseline times tolerance.
+Use --update to record new baselines on the current machine.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+import contextlib
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+TOOL_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, TOOL_DIR)
+sys.path.insert(0, f"{TOOL_DIR}/uf2-samd21/lib/uf2/utils")
+sys.path.insert(0, f"{TOOL_DIR}/uf2-samd21/scripts")
+import uf2conv
+import gendata
+import SAMDconfig
+
+BASELINES_FILE = f"{BENCH_DIR}/baselines.json"
+SIZES = {'8K': 8 << 10, '64K': 64 << 10, '512K': 512 << 10, '1M': 1 << 20, '8M': 8 << 20}
+QUICK_SIZES = ['8K', '64K', '512K']
+# differences below these are noise, not regressions
+TIME_SLACK = 0.005
+MEMORY_SLACK = 256 << 10
+
+# stub toolchain: compiler writes some bytes to its output, and make produces the files the
+# real Makefile would, so that the pipeline runs without arm-none-eabi-gcc
+STUB_GCC = '''#!/usr/bin/env python3
+import sys
+if '--version' in sys.argv:
+    print("arm-none-eabi-gcc (benchmark stub) 0.0.0")
+'''
+STUB_MAKE = '''#!/usr/bin/env python3
+import os, sys
+args = dict(arg.split('=', 1) for arg in sys.argv[1:] if '=' in arg)
+name = "bootloader-%s-%s" % (args['BOARD'], args['VERSION'])
+path = "build/" + args['BOARD']
+os.makedirs(path, exist_ok = True)
+for filename in [name + ".bin", name + ".elf", name + ".map", "update-" + name + ".bin",
+                 "update-" + name + ".uf2", "update-" + name + ".ino"]:
+    with open(os.path.join(path, filename), "wb") as f:
+        f.write(os.urandom(8000))
+'''
+
+def make_hex(data, base):
+    # Intel HEX with 16-byte data records and extended linear address records
+    lines = []
+    upper = None
+    for ptr in range(0, len(data), 16):
+        addr = base + ptr
+        if addr >> 16 != upper:
+            upper = addr >> 16
+            rec = bytes([2, 0, 0, 4, upper >> 8, upper & 0xff])
+            lines.append(":" + (rec + bytes([-sum(rec) & 0xff])).hex().upper())
+        rec = bytes([len(data[ptr:ptr + 16]), (addr >> 8) & 0xff, addr & 0xff, 0]) + data[ptr:ptr + 16]
+        lines.append(":" + (rec + bytes([-sum(rec) & 0xff])).hex().upper())
+    lines.append(":00000001FF")
+    return "\n".join(lines) + "\n"
+
+# creates temporary tree with board config, variant files, stub toolchain and ARDUINO15 folder
+def make_board_tree(root):
+    home = f"{root}/home"
+    gcc_bin = f"{home}/arduino15/packages/adafruit/tools/arm-none-eabi-gcc/9-2019q4/bin"
+    stub_bin = f"{root}/stubs"
+    os.makedirs(gcc_bin)
+    os.makedirs(stub_bin)
+    for directory, name, content in [(gcc_bin, 'arm-none-eabi-gcc', STUB_GCC), (stub_bin, 'make', STUB_MAKE)]:
+        with open(f"{directory}/{name}", 'w', encoding = 'UTF-8') as f:
+            f.write(content)
+        os.chmod(f"{directory}/{name}", 0o755)
+    board_data = f"{root}/board_data"
+    os.makedirs(board_data)
+    with open(f"{TOOL_DIR}/board_data/board-config.ini", 'r', encoding = 'UTF-8') as f:
+        config = f.read()
+    config = config.replace("ARDUINO15 = Library/Arduino15", "ARDUINO15 = arduino15")
+    config = config.replace("MAKE_PATH = /usr/bin", f"MAKE_PATH = {stub_bin}")
+    with open(f"{board_data}/board-config.ini", 'w', encoding = 'UTF-8') as f:
+        f.write(config)
+    shutil.copy(f"{TOOL_DIR}/board_data/variant-ZERO.cpp", f"{board_data}/variant.cpp")
+    shutil.copy(f"{TOOL_DIR}/board_data/variant-ZERO.h", f"{board_data}/variant.h")
+    env = dict(os.environ, HOME = home, SAMD_BOARD_CACHE = f"{root}/cache")
+    return(f"{board_data}/board-config.ini", env)
+
+# runs function repeat times, returns best wall time and peak traced memory; output printed
+# by the function is discarded. Memory of subprocesses (makeboard.py) is not traced
+def measure(function, repeat):
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return(min(times), peak)
+
+def conversion_benchmarks(tmp, sizes):
+    benchmarks = {}
+    for size_name in sizes:
+        data = os.urandom(SIZES[size_name])
+        uf2 = uf2conv.convert_to_uf2(data)
+        hex_text = make_hex(data, 0x2000)
+        bin_file, uf2_file = f"{tmp}/in-{size_name}.bin", f"{tmp}/in-{size_name}.uf2"
+        for filename, content in [(bin_file, data), (uf2_file, uf2)]:
+            with open(filename, 'wb') as f:
+                f.write(content)
+        # default arguments bind values of this iteration
+        benchmarks.update({
+            f"convert_to_uf2/{size_name}": lambda data = data: uf2conv.convert_to_uf2(data),
+            f"convert_file_to_uf2/{size_name}":
+                lambda f = bin_file: uf2conv.convert_file_to_uf2(f, f + ".uf2"),
+            f"convert_from_uf2/{size_name}": lambda uf2 = uf2: uf2conv.convert_from_uf2(uf2),
+            f"convert_uf2_file_to_bin/{size_name}":
+                lambda f = uf2_file: uf2conv.convert_uf2_file_to_bin(f, f + ".bin"),
+            f"convert_from_hex_to_uf2/{size_name}": lambda text = hex_text: uf2conv.convert_from_hex_to_uf2(text),
+            f"convert_to_carray/{size_name}": lambda data = data: uf2conv.convert_to_carray(data),
+        })
+    for bootloader_size in [8192, 16384]:
+        bootloader = bytearray(os.urandom(bootloader_size - 1000)) + bytearray([0xff] * 1000)
+        benchmarks[f"gendata/{bootloader_size // 1024}K"] = \
+            lambda b = bootloader, size = bootloader_size: gendata.selfdata_c(b, size)
+    return(benchmarks)
+
+def pipeline_benchmarks(tmp):
+    config_file, env = make_board_tree(f"{tmp}/pipeline")
+    workdir = f"{tmp}/pipeline"
+    board = SAMDconfig.SAMDconfig(config_file)
+    def setup():
+        board.setup_build_directory(f"{workdir}/build-setup")
+    def archive():
+        board.package_archive()
+    def makeboard(*options):
+        result = subprocess.run([sys.executable, f"{TOOL_DIR}/makeboard.py", config_file] + list(options),
+                                cwd = workdir, env = env, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, text = True)
+        if result.returncode:
+            raise RuntimeError("makeboard.py failed:\n" + result.stdout)
+    with contextlib.redirect_stdout(io.StringIO()):
+        setup()
+    return({
+        "setup_build_directory": setup,
+        "package_archive": archive,
+        "makeboard/no-cache": lambda: makeboard('--no-bootloader-cache', '--no-object-cache'),
+        "makeboard/cached": lambda: makeboard(),
+    })
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark uf2conv, gendata and makeboard pipeline.')
+    parser.add_argument('--update', action = 'store_true', help = 'record results as new baselines')
+    parser.add_argument('--quick', action = 'store_true', help = f"only use sizes {', '.join(QUICK_SIZES)}")
+    parser.add_argument('--tolerance', type = float, default = 2.0,
+                        help = 'fail if time or memory exceeds baseline times this factor (default: 2.0)')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'number of timed runs (default: 3)')
+    parser.add_argument('--only', type = str, default = None, help = 'only run benchmarks whose name contains this')
+    args = parser.parse_args()
+
+    baselines = {}
+    if os.path.exists(BASELINES_FILE):
+        with open(BASELINES_FILE, 'r', encoding = 'UTF-8') as f:
+            baselines = json.load(f)
+
+    results = {}
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        benchmarks = conversion_benchmarks(tmp, QUICK_SIZES if args.quick else list(SIZES))
+        if os.name == 'posix':
+            benchmarks.update(pipeline_benchmarks(tmp))
+        print(f"{'benchmark':36} {'time, ms':>10} {'baseline':>10} {'peak mem, KB':>13} {'baseline':>10}")
+        for name, function in benchmarks.items():
+            if args.only and args.only not in name:
+                continue
+            seconds, peak = measure(function, args.repeat)
+            results[name] = {'time': seconds, 'memory': peak}
+            baseline = baselines.get(name)
+            status = ''
+            if baseline is not None and not args.update:
+                if seconds > baseline['time'] * args.tolerance + TIME_SLACK:
+                    status = 'SLOWER'
+                elif peak > baseline['memory'] * args.tolerance + MEMORY_SLACK:
+                    status = 'MORE MEMORY'
+                if status:
+                    failures.append((name, status, seconds, peak, baseline))
+            print(f"{name:36} {seconds * 1000:10.1f} {baseline['time'] * 1000 if baseline else float('nan'):10.1f} "
+                  f"{peak / 1024:13.0f} {baseline['memory'] / 1024 if baseline else float('nan'):10.0f} {status}")
+
+    if args.update:
+        baselines.update(results)
+        with open(BASELINES_FILE, 'w', encoding = 'UTF-8') as f:
+            json.dump(baselines, f, indent = 2, sort_keys = True)
+        print(f"Saved baselines to {BASELINES_FILE}")
+    elif failures:
+        print(f"\n{len(failures)} benchmark(s) regressed (tolerance {args.tolerance}x):")
+        for name, status, seconds, peak, baseline in failures:
+            print(f"  {name}: {status}; time {seconds * 1000:.1f} ms (baseline {baseline['time'] * 1000:.1f} ms), "
+                  f"peak memory {peak // 1024} KB (baseline {baseline['memory'] // 1024} KB)")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,350 @@
 #!/usr/bin/env python3
 import SAMDconfig
+import BuildTrace
+import Footprint
+import ConfigValidator
+import MirrorServer
 import os
+import sys
+import time
 import shutil
+import threading
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-# Read all board configuration data 
-print("Reading board config...")
-board = SAMDconfig.SAMDconfig("board_data/board-config.ini")
-
-# setup buidl directory and move there all source files     
-print("Copying sources to build directory...")
-board.setup_build_directory('build')
-
-# write config files for bootloader 
-print("Creating config files for the board bootloader")
-bootloader_config_dir = f"{board.build_directory}/uf2-samd21/boards/{board.name}"
-os.mkdir(bootloader_config_dir)
-board.write_board_mk(bootloader_config_dir)
-board.write_board_config(bootloader_config_dir)
-
-# build bootloader 
-print("Building bootloader...")
-bootloader_dir, bootloader_basename = board.build_bootloader()
-
-# copy built bootloader into the package 
-bootloader_dest = f"{board.package_directory}/bootloaders/{board.name}"
-os.mkdir(bootloader_dest)
-shutil.copy(f"{bootloader_dir}/{bootloader_basename}.bin", bootloader_dest)
-shutil.copy(f"{bootloader_dir}/{bootloader_basename}.elf", bootloader_dest)
-#also, copy to the top of build directory
-shutil.copy(f"{bootloader_dir}/{bootloader_basename}.bin", board.build_directory)
-
-# add bootloader filename to dictionary
-board.d['bootloader_filename']=f"{bootloader_basename}.bin"
-
-# create boards.txt, platform.txt, README.md
-print("Writing boards.txt file")
-board.write_boards_txt()
-
-#compressing directory into zip archive 
-board.package_archive()
-
-# create json file 
-print("Creating json index file")
-board.write_index_json()
+# watched files are checked for changes this often, in seconds
+WATCH_INTERVAL = 0.2
+# changing any of these config values changes build directory layout, so everything is built again
+LAYOUT_KEYS = ['board_name', 'package_version', 'chip_family', 'chip_variant']
+# changing any of these config values may change the compiler or make used, so the bootloader is built again
+TOOLCHAIN_KEYS = ['arduino15', 'gcc_version', 'make_path']
+
+# writes board.mk and board_config.h for the bootloader; returns True if either changed
+def write_bootloader_config(board, trace):
+    print("Creating config files for the board bootloader")
+    with trace.stage("bootloader config", board.name):
+        bootloader_config_dir = f"{board.build_directory}/uf2-samd21/boards/{board.name}"
+        os.makedirs(bootloader_config_dir, exist_ok = True)
+        changed = board.write_board_mk(bootloader_config_dir)
+        changed = board.write_board_config(bootloader_config_dir) or changed
+    return(changed)
+
+# builds bootloader and checks that it fits; returns (bootloader directory, bootloader basename)
+def make_bootloader(board, trace, make_jobs = None, object_cache = True, artifact_cache = True,
+                    record_footprint = True):
+    print("Building bootloader...")
+    with trace.stage("make", board.name):
+        bootloader_dir, bootloader_basename = board.build_bootloader(make_jobs, object_cache, artifact_cache)
+    print("Checking bootloader size...")
+    with trace.stage("footprint", board.name):
+        board.check_footprint(bootloader_dir, bootloader_basename, record_footprint)
+    return(bootloader_dir, bootloader_basename)
+
+# copies built bootloader into the package, and to the top of build directory
+def copy_bootloader(board, bootloader_dir, bootloader_basename, trace):
+    with trace.stage("artifact copy", board.name) as stage:
+        bootloader_dest = f"{board.package_directory}/bootloaders/{board.name}"
+        os.makedirs(bootloader_dest, exist_ok = True)
+        copied = 0
+        for filename in [f"{bootloader_basename}.bin", f"{bootloader_basename}.elf"]:
+            copied += SAMDconfig.sync_file(f"{bootloader_dir}/{filename}", f"{bootloader_dest}/{filename}")
+        copied += SAMDconfig.sync_file(f"{bootloader_dir}/{bootloader_basename}.bin",
+                                       f"{board.build_directory}/{bootloader_basename}.bin")
+        stage['bytes_copied'] = copied
+
+# compresses package directory into archive(s) and writes json index file
+def package_board(board, trace, archive_formats = ('zip',), compresslevel = 9, update_package_index = True):
+    with trace.stage("archive", board.name) as stage:
+        archives = board.package_archive(archive_formats, compresslevel)
+        stage['bytes_written'] = sum(size for filename, size, checksum in archives)
+    print("Creating json index file")
+    with trace.stage("index", board.name):
+        board.write_index_json(update_package_index)
+
+# builds bootloader and package for one board, described by given config file,
+# in given build directory. Returns board config object; timing of all stages is recorded in trace
+# (a new one, if not given) and also saved as board.build_stages. Unless sequential is True,
+# make runs in a worker thread while package files are copied and rendered
+def build_board(config_filename, build_dir, link_sources = True, make_jobs = None, object_cache = True,
+                artifact_cache = True, archive_formats = ('zip',), compresslevel = 9,
+                update_package_index = True, incremental = False, trace = None, record_footprint = True,
+                sequential = False):
+    if trace is None:
+        trace = BuildTrace.BuildTrace()
+    first_stage = len(trace.stages)
+    # Read all board configuration data
+    print(f"Reading board config {config_filename}...")
+    with trace.stage("config parse") as stage:
+        board = SAMDconfig.SAMDconfig(config_filename)
+        stage['board'] = board.name
+    if build_dir is None:
+        # batch mode: each board gets its own build directory
+        build_dir = f"build/{board.name}"
+
+    # setup build directory and link there all bootloader source files
+    print("Setting up build directory...")
+    with trace.stage("setup", board.name) as stage:
+        stage['bytes_copied'] = board.setup_bootloader_directory(build_dir, link_sources = link_sources,
+                                                                 clean = not incremental)
+
+    # write config files for bootloader
+    write_bootloader_config(board, trace)
+
+    # add bootloader filename to dictionary
+    board.d['bootloader_filename']=f"{board.bootloader_basename()}.bin"
+
+    # copy package template and variant files, and create boards.txt, platform.txt, README.md; they
+    # don't depend on the built bootloader, so this is done while make is running. If make fails,
+    # the exception is raised by result()
+    with ThreadPoolExecutor(max_workers = 1) as executor:
+        if sequential:
+            bootloader_dir, bootloader_basename = make_bootloader(board, trace, make_jobs, object_cache,
+                                                                  artifact_cache, record_footprint)
+        else:
+            make_future = executor.submit(make_bootloader, board, trace, make_jobs, object_cache,
+                                          artifact_cache, record_footprint)
+        print("Copying package files")
+        with trace.stage("package setup", board.name, subprocesses = False) as stage:
+            stage['bytes_copied'] = board.setup_package_directory()
+        print("Writing boards.txt file")
+        with trace.stage("render", board.name, subprocesses = False):
+            board.write_boards_txt()
+        if not sequential:
+            bootloader_dir, bootloader_basename = make_future.result()
+
+    # copy built bootloader into the package
+    copy_bootloader(board, bootloader_dir, bootloader_basename, trace)
+
+    #compressing directory into zip archive, and create json file
+    package_board(board, trace, archive_formats, compresslevel, update_package_index)
+    board.build_stages = trace.stages[first_stage:]
+    return(board)
+
+# builds several boards at once, each in its own build directory under build/,
+# then combines packages of each vendor into one package with merged boards.txt, listed as one
+# platform in merged index file. Existing index file given by PACKAGE_INDEX, and footprint history,
+# are only updated once, after all boards are built
+def build_batch(config_filenames, jobs, link_sources, make_jobs = None, object_cache = True,
+                artifact_cache = True, archive_formats = ('zip',), compresslevel = 9, incremental = False,
+                trace = None, sequential = False):
+    if trace is None:
+        trace = BuildTrace.BuildTrace()
+    # make sure no two boards would share a build directory, and that boards of each vendor can be
+    # combined into one package, before anything is built
+    board_names = {}
+    configs = []
+    for filename in config_filenames:
+        config = SAMDconfig.SAMDconfig(filename)
+        name = config.name
+        if name in board_names:
+            raise RuntimeError(f"Board name {name} is used both in {board_names[name]} and {filename}")
+        board_names[name] = filename
+        configs.append(config)
+    SAMDconfig.check_combinable(configs)
+    if os.path.exists('build') and not incremental:
+        print("Removing old build directory")
+        shutil.rmtree('build')
+    os.makedirs('build', exist_ok = True)
+    with ProcessPoolExecutor(max_workers = jobs) as executor:
+        futures = [executor.submit(build_board, filename, None, link_sources, make_jobs, object_cache,
+                                   artifact_cache, archive_formats, compresslevel, False, incremental,
+                                   None, False, sequential) for filename in config_filenames]
+        boards = [future.result() for future in futures]
+    # stages were recorded in worker processes
+    for board in boards:
+        trace.add_stages(board.build_stages)
+        Footprint.record_history(board.footprint_history_file(), board.name, board.version, board.footprint)
+    print("Creating combined package and merged json index file")
+    with trace.stage("index"):
+        SAMDconfig.write_merged_index_json(boards, 'build', archive_formats, compresslevel)
+    return(boards)
+
+
+# keeps one board built while its files are edited: watches config file, variant files and package
+# template, and re-runs only the build stages affected by each change. Parsed config and resolved
+# toolchain are kept between builds. Existing index file given by PACKAGE_INDEX is only updated
+# on each build if update_package_index is True
+class BoardWatcher:
+    def __init__(self, config_filename, build_dir = 'build', link_sources = True, make_jobs = None,
+                 object_cache = True, artifact_cache = True, archive_formats = ('zip',), compresslevel = 9,
+                 update_package_index = False):
+        self.config_filename = os.path.abspath(config_filename)
+        self.data_directory = os.path.dirname(self.config_filename)
+        self.build_dir = build_dir
+        self.link_sources = link_sources
+        self.make_options = (make_jobs, object_cache, artifact_cache)
+        self.archive_formats = archive_formats
+        self.compresslevel = compresslevel
+        self.update_package_index = update_package_index
+        # None until a build succeeds; after a failed build, the next change builds everything again
+        self.board = None
+
+    # returns {filename: (mtime, size)} of all watched files
+    def snapshot(self):
+        filenames = [self.config_filename, f"{self.data_directory}/variant.cpp", f"{self.data_directory}/variant.h"]
+        for root, dirnames, names in os.walk(SAMDconfig.TEMPLATE_DIR):
+            filenames += [os.path.join(root, name) for name in names if name != '.DS_Store']
+        state = {}
+        for filename in filenames:
+            try:
+                st = os.stat(filename)
+            except OSError:
+                # e.g. file being replaced by editor; it will be seen in the next snapshot
+                continue
+            state[filename] = (st.st_mtime_ns, st.st_size)
+        return(state)
+
+    # builds everything; build directory is kept, so only files that changed are written
+    def build(self, trace):
+        self.board = build_board(self.config_filename, self.build_dir, self.link_sources, *self.make_options,
+                                 self.archive_formats, self.compresslevel, self.update_package_index,
+                                 incremental = True, trace = trace)
+
+    # re-runs the stages affected by changed files: config file changes bootloader config (and bootloader,
+    # if board.mk, board_config.h or toolchain settings changed) and rendered files; variant files and
+    # other template files are copied. The package is archived and indexed again after any change
+    def rebuild(self, changed, trace):
+        board = self.board
+        config_changed = self.config_filename in changed
+        templates = [filename for filename in changed if filename.startswith(SAMDconfig.TEMPLATE_DIR + os.sep)]
+        render_templates = [filename for filename in templates
+                            if os.path.dirname(filename) == SAMDconfig.TEMPLATE_DIR and '_TEMPLATE' in os.path.basename(filename)]
+        if config_changed:
+            with trace.stage("config parse") as stage:
+                new_board = SAMDconfig.SAMDconfig(self.config_filename)
+                stage['board'] = new_board.name
+            if any(new_board.d[key] != board.d[key] for key in LAYOUT_KEYS):
+                self.build(trace)
+                return
+            toolchain_changed = any(new_board.d.get(key) != board.d.get(key) for key in TOOLCHAIN_KEYS)
+            if toolchain_changed:
+                # make doesn't know that objects depend on the compiler, so they are all built again
+                shutil.rmtree(f"{board.build_directory}/uf2-samd21/build/{board.name}", ignore_errors = True)
+            else:
+                new_board.toolchain = board.toolchain
+            new_board.build_directory = board.build_directory
+            new_board.package_directory = board.package_directory
+            new_board.renderer = board.renderer
+            new_board.d['bootloader_filename'] = board.d['bootloader_filename']
+            board = self.board = new_board
+        if len(templates) > len(render_templates):
+            with trace.stage("setup", board.name) as stage:
+                stage['bytes_copied'] = board.setup_build_directory(self.build_dir, self.link_sources, clean = False)
+        elif changed & {f"{self.data_directory}/variant.cpp", f"{self.data_directory}/variant.h"}:
+            with trace.stage("setup", board.name) as stage:
+                stage['bytes_copied'] = board.copy_variant_files()
+        if config_changed and (write_bootloader_config(board, trace) or toolchain_changed):
+            bootloader_dir, bootloader_basename = make_bootloader(board, trace, *self.make_options)
+            copy_bootloader(board, bootloader_dir, bootloader_basename, trace)
+        if config_changed or render_templates:
+            print("Writing boards.txt file")
+            with trace.stage("render", board.name):
+                board.write_boards_txt()
+        package_board(board, trace, self.archive_formats, self.compresslevel, self.update_package_index)
+
+    # builds, then rebuilds after every change until interrupted with Ctrl-C
+    def run(self):
+        state = {}
+        try:
+            while True:
+                new_state = self.snapshot()
+                changed = {filename for filename in state.keys() | new_state.keys()
+                           if state.get(filename) != new_state.get(filename)}
+                state = new_state
+                if changed:
+                    trace = BuildTrace.BuildTrace()
+                    start = time.perf_counter()
+                    try:
+                        if self.board is None:
+                            self.build(trace)
+                        else:
+                            self.rebuild(changed, trace)
+                        print(f"Done in {time.perf_counter() - start:.2f} s: {', '.join(record['stage'] for record in trace.stages)}")
+                    except Exception as e:
+                        # e.g. invalid config or failed make; keep watching for the fix
+                        print(f"Build failed: {e}")
+                        self.board = None
+                    print(f"Watching {self.data_directory} and {SAMDconfig.TEMPLATE_DIR} for changes (Ctrl-C to stop)")
+                time.sleep(WATCH_INTERVAL)
+        except KeyboardInterrupt:
+            pass
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build bootloader and Arduino package for custom SAMD board.')
+    parser.add_argument('config', metavar='CONFIG', nargs='*', default=['board_data/board-config.ini'],
+                        help='board config file(s); if several are given, all boards are built in parallel (default: board_data/board-config.ini)')
+    parser.add_argument('--copy-sources', action='store_true',
+                        help='copy bootloader sources into build directory instead of symlinking them')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of boards to build at the same time (default: number of CPUs)')
+    parser.add_argument('--make-jobs', type=int, default=None,
+                        help='number of parallel make jobs for each bootloader build (default: number of CPUs)')
+    parser.add_argument('--no-object-cache', action='store_true',
+                        help='always compile all bootloader sources, do not use cached objects')
+    parser.add_argument('--no-bootloader-cache', action='store_true',
+                        help='always run make, even if a bootloader with the same inputs was built before')
+    parser.add_argument('--archive-format', dest='archive_formats', action='append',
+                        choices=['zip', 'tar.gz', 'tar.bz2'],
+                        help='package archive format; can be given several times, the first one is used in index file (default: zip)')
+    parser.add_argument('--compress-level', type=int, default=9, choices=range(1, 10), metavar='1-9',
+                        help='archive compression level (default: 9)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='keep build directory from previous run and only update files that changed')
+    parser.add_argument('--sequential', action='store_true',
+                        help='run all build stages one after another, instead of copying and rendering package files while make runs')
+    parser.add_argument('--check', action='store_true',
+                        help='only validate config files (values, duplicate board names, toolchain and make paths), do not build')
+    parser.add_argument('--report', metavar='FILE', default=None,
+                        help='save wall time, CPU time, bytes copied and subprocess usage of each build stage as JSON')
+    parser.add_argument('--trace', metavar='FILE', default=None,
+                        help='save build stages as Chrome trace file (open in chrome://tracing or ui.perfetto.dev)')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running, and rebuild only what is needed whenever config, variant or template files change; existing index file given by PACKAGE_INDEX is not updated')
+    parser.add_argument('--serve', metavar='PORT', type=int, default=None,
+                        help='after building (or while watching), serve index file and package archives on this port for Arduino IDE')
+    args = parser.parse_args()
+    if args.archive_formats is None:
+        args.archive_formats = ['zip']
+
+    # the same config file given twice is only built once
+    args.config = ConfigValidator.unique_files(args.config)
+    # check all config files before starting any build, reporting all errors at once
+    if ConfigValidator.print_errors(ConfigValidator.validate_configs(args.config, args.jobs)):
+        sys.exit(1)
+    if args.check:
+        print(f"{len(args.config)} config file(s) OK")
+        sys.exit(0)
+
+    if args.watch:
+        if len(args.config) != 1:
+            print("Watch mode only supports one config file")
+            sys.exit(1)
+        if args.serve is not None:
+            # served files are picked up again as they are rebuilt
+            print(f"Serving build directory on port {args.serve}")
+            server = MirrorServer.MirrorServer('build', port = args.serve)
+            threading.Thread(target = server.run, daemon = True).start()
+        BoardWatcher(args.config[0], 'build', not args.copy_sources, args.make_jobs, not args.no_object_cache,
+                     not args.no_bootloader_cache, args.archive_formats, args.compress_level).run()
+        sys.exit(0)
+
+    trace = BuildTrace.BuildTrace()
+    if len(args.config) == 1:
+        build_board(args.config[0], 'build', not args.copy_sources, args.make_jobs, not args.no_object_cache,
+                    not args.no_bootloader_cache, args.archive_formats, args.compress_level,
+                    incremental = args.incremental, trace = trace, sequential = args.sequential)
+    else:
+        build_batch(args.config, args.jobs, not args.copy_sources, args.make_jobs, not args.no_object_cache,
+                    not args.no_bootloader_cache, args.archive_formats, args.compress_level, args.incremental, trace, args.sequential)
+    if args.report or args.trace:
+        trace.print_summary()
+    if args.report:
+        trace.save_report(args.report)
+        print(f"Saved build report to {args.report}")
+    if args.trace:
+        trace.save_chrome_trace(args.trace)
+        print(f"Saved build trace to {args.trace}")
+    if args.serve is not None:
+        MirrorServer.MirrorServer('build', port = args.serve).run()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Compiler wrapper caching object files of the bootloader build
+* Author(s): Alexander Kirillov
+* Version: 4.0
+
+Usage: objcache.py COMPILER ARGS...
+
+Used by SAMDconfig.build_bootloader as CC for make. Compile commands (-c ... -o file.o)
+are looked up in the cache, keyed on preprocessed source (which covers board_config.h
+and all other headers), compiler flags and compiler version; everything else, e.g. linking,
+is passed to the compiler unchanged. Cache directory is given by SAMD_OBJECT_CACHE
+environment variable; compiler version can be passed in SAMD_COMPILER_ID to avoid
+running compiler --version for every object.
+"""
+
+import os
+import sys
+import shutil
+import hashlib
+import subprocess
+import tempfile
+
+# returns the cached object file name for given compile command, or None if the
+# command can't be cached
+def cache_key(compiler, args):
+    if '-c' not in args or '-o' not in args or '-E' in args:
+        return None
+    sources = [arg for arg in args if arg.endswith('.c')]
+    if len(sources) != 1:
+        return None
+    # preprocess without line markers: include paths, which are different for every board,
+    # don't end up in the key, so sibling boards can share objects
+    output_index = args.index('-o')
+    preprocess_args = [arg for i, arg in enumerate(args)
+                       if arg != '-c' and i not in (output_index, output_index+1)]
+    preprocessed = subprocess.run([compiler, '-E', '-P'] + preprocess_args, stdout = subprocess.PIPE)
+    if preprocessed.returncode:
+        return None
+    compiler_id = os.environ.get('SAMD_COMPILER_ID')
+    if not compiler_id:
+        compiler_id = subprocess.run([compiler, '--version'], stdout = subprocess.PIPE, text = True).stdout
+    key = hashlib.sha256()
+    key.update(compiler_id.encode('UTF-8'))
+    # flags, except for output, include paths and source name
+    for i, arg in enumerate(args):
+        if i in (output_index, output_index+1) or arg.startswith('-I') or arg in sources:
+            continue
+        key.update(arg.encode('UTF-8') + b'\0')
+    key.update(preprocessed.stdout)
+    return key.hexdigest()
+
+def main():
+    compiler = sys.argv[1]
+    args = sys.argv[2:]
+    cache_dir = os.environ.get('SAMD_OBJECT_CACHE')
+    key = cache_key(compiler, args) if cache_dir else None
+    if key is None:
+        sys.exit(subprocess.run([compiler] + args).returncode)
+
+    output = args[args.index('-o') + 1]
+    cached_object = f"{cache_dir}/{key[:2]}/{key}.o"
+    if os.path.exists(cached_object):
+        shutil.copyfile(cached_object, output)
+        print(f"objcache: {output} (cached)")
+        return
+    # debug info records the compile directory, which is the build directory of this board; map it
+    # to ".", so that the cached object is right for every board using it. The flag is not part of the key
+    result = subprocess.run([compiler] + args + [f"-fdebug-prefix-map={os.getcwd()}=."])
+    if result.returncode:
+        sys.exit(result.returncode)
+    # store object; write to temporary file first, so that parallel builds never see partial files
+    os.makedirs(os.path.dirname(cached_object), exist_ok = True)
+    fd, temp_name = tempfile.mkstemp(dir = os.path.dirname(cached_object))
+    os.close(fd)
+    shutil.copyfile(output, temp_name)
+    os.replace(temp_name, cached_object)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import io
 import sys
 import struct
 import subprocess
@@ -6,12 +7,29 @@ import re
 import os
 import os.path
 import argparse
+import mmap
+import binascii
+import time
+import getpass
+import hashlib
+import json
+import threading
+import bisect
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 
 UF2_MAGIC_START0 = 0x0A324655 # "UF2\n"
 UF2_MAGIC_START1 = 0x9E5D5157 # Randomly selected
 UF2_MAGIC_END    = 0x0AB16F30 # Ditto
 
+UF2_HEADER = struct.Struct(b"<IIIIIIII")
+UF2_END = struct.pack(b"<I", UF2_MAGIC_END)
+# number of 256-byte chunks converted at once when streaming
+STREAM_BLOCKS = 1024
+# data added to SparseImage in pieces smaller than this is copied, not viewed
+SMALL_PIECE = 64
+
 families = {
     'SAMD21': 0x68ed2b88,
     'SAML21': 0x1851780a,
@@ -24,12 +42,39 @@ families = {
 }
 
 INFO_FILE = "/INFO_UF2.TXT"
-
-appstartaddr = 0x2000
-familyid = 0x0
+MOUNTS_FILE = "/proc/mounts"
+# UF2 bootloaders present a FAT file system
+UF2_FILESYSTEMS = ("vfat", "msdos", "fat")
+# size of each write to a drive; fsync is only done at the end of the file
+WRITE_CHUNK = 64 * 1024
+# block hash index of a delta base image is cached in a file with this suffix
+# next to the base image
+BLOCK_INDEX_SUFFIX = ".blockindex.json"
+# changed whenever the way blocks are laid out changes, so that older cached
+# indexes are rebuilt
+BLOCK_INDEX_VERSION = 2
+# index of blocks of UF2 file read by UF2Reader is cached in a file with this
+# suffix next to it: header (magic, size and mtime of UF2 file, number of
+# skipped blocks and of index entries), offsets of skipped blocks, entries
+UF2_INDEX_SUFFIX = ".uf2index"
+UF2_INDEX_HEADER = struct.Struct(b"<8sQQII")
+UF2_INDEX_MAGIC = b"UF2INDX1"
+UF2_INDEX_ENTRY = struct.Struct(b"<IIIIIII")
+# block flags, as defined by UF2 specification
+UF2_FLAGS = {
+    0x00000001: "not-main-flash",
+    0x00001000: "file-container",
+    0x00002000: "family-id",
+    0x00004000: "md5",
+    0x00008000: "extension-tags",
+}
+# image formats which can be read and written
+IMAGE_FORMATS = ("bin", "hex", "uf2")
 
 
 def is_uf2(buf):
+    if len(buf) < 8:
+        return False
     w = struct.unpack("<II", buf[0:8])
     return w[0] == UF2_MAGIC_START0 and w[1] == UF2_MAGIC_START1
 
@@ -38,141 +83,757 @@ def is_hex(buf):
         w = buf[0:30].decode("utf-8")
     except UnicodeDecodeError:
         return False
-    if w[0] == ':' and re.match(b"^[:0-9a-fA-F\r\n]+$", buf):
+    if w[:1] == ':' and re.match(b"^[:0-9a-fA-F\r\n]+$", buf):
         return True
     return False
 
-def convert_from_uf2(buf):
-    global appstartaddr
-    numblocks = len(buf) // 512
-    curraddr = None
-    outp = b""
-    for blockno in range(numblocks):
-        ptr = blockno * 512
-        block = buf[ptr:ptr + 512]
-        hd = struct.unpack(b"<IIIIIIII", block[0:32])
-        if hd[0] != UF2_MAGIC_START0 or hd[1] != UF2_MAGIC_START1:
-            print("Skipping block at " + ptr + "; bad magic")
+def decode_uf2(buf):
+    # parses all blocks in buf (bytes or mmap) without copying payloads;
+    # returns list of (address, payload memoryview) of blocks to be flashed,
+    # sorted by address, and a report of skipped, duplicate and missing blocks
+    view = memoryview(buf)
+    segments = []
+    report = {"skipped": [], "duplicate": [], "missing": []}
+    # block numbers seen, for each family/number of blocks
+    seen = {}
+    for ptr in range(0, len(buf) - 511, 512):
+        hd = UF2_HEADER.unpack_from(buf, ptr)
+        flags, addr, datalen, blockno, numblocks = hd[2:7]
+        if hd[0] != UF2_MAGIC_START0 or hd[1] != UF2_MAGIC_START1 or datalen > 476:
+            # not a valid block; skipped, as UF2Reader does
+            report["skipped"].append(ptr)
             continue
-        if hd[2] & 1:
+        family = hd[7] if flags & 0x2000 else 0
+        blocknos = seen.setdefault((family, numblocks), set())
+        if blockno in blocknos:
+            report["duplicate"].append(blockno)
+        blocknos.add(blockno)
+        if flags & 1:
             # NO-flash flag set; skip block
             continue
-        datalen = hd[4]
-        if datalen > 476:
-            assert False, "Invalid UF2 data size at " + ptr
-        newaddr = hd[3]
-        if curraddr == None:
-            appstartaddr = newaddr
-            curraddr = newaddr
-        padding = newaddr - curraddr
-        if padding < 0:
-            assert False, "Block out of order at " + ptr
-        if padding > 10*1024*1024:
-            assert False, "More than 10M of padding needed at " + ptr
-        if padding % 4 != 0:
-            assert False, "Non-word padding size at " + ptr
-        while padding > 0:
-            padding -= 4
-            outp += b"\x00\x00\x00\x00"
-        outp += block[32 : 32 + datalen]
-        curraddr = newaddr + datalen
+        segments.append((addr, view[ptr + 32 : ptr + 32 + datalen]))
+    for (family, numblocks), blocknos in seen.items():
+        report["missing"] += [n for n in range(numblocks) if n not in blocknos]
+    # stable sort: of duplicate blocks, the last one in file wins
+    segments.sort(key=lambda segment: segment[0])
+    return segments, report
+
+def print_uf2_report(report):
+    for ptr in report["skipped"]:
+        print("Skipping block at %d; bad magic or payload size" % ptr)
+    if report["duplicate"]:
+        print("Warning: duplicate blocks: " + ", ".join(map(str, report["duplicate"])))
+    if report["missing"]:
+        print("Warning: missing blocks: " + ", ".join(map(str, report["missing"])))
+
+def add_piece(pieces, data):
+    # appends data to list of pieces of a segment and returns the list. Small
+    # data (e.g. HEX records) is copied into the last piece, as a view would
+    # take more memory than the data itself; other data is kept as a view
+    if len(data) < SMALL_PIECE:
+        if pieces and isinstance(pieces[-1], bytearray):
+            pieces[-1] += data
+        else:
+            pieces.append(bytearray(data))
+    else:
+        pieces.append(data if isinstance(data, memoryview) else memoryview(data))
+    return pieces
+
+class SparseImage:
+    # firmware image as address-sorted, non-overlapping segments [address, size,
+    # pieces], shared by all readers and writers. Each segment is a run of
+    # contiguous data, kept as the list of pieces it was added in: data is kept
+    # as a view of what was given (e.g. of a memory-mapped file), not copied,
+    # unless it is smaller than SMALL_PIECE. Only data which overlaps a segment
+    # is merged with it into one bytearray, and data added later wins. Memory
+    # use depends on the amount of data, not on the address span, so images
+    # with several far apart regions are cheap
+    def __init__(self):
+        self.segments = []
+        # start addresses of segments, for bisect
+        self.starts = []
+
+    def __iter__(self):
+        # yields (address, data) of each piece, in address order; pieces of one
+        # segment are contiguous
+        for addr, size, pieces in self.segments:
+            for data in pieces:
+                yield addr, data
+                addr += len(data)
+
+    def add(self, addr, data):
+        size = len(data)
+        if not size:
+            return
+        end = addr + size
+        segments, starts = self.segments, self.starts
+        if segments and starts[-1] <= addr:
+            last = segments[-1]
+            last_end = last[0] + last[1]
+            if last_end == addr:
+                # common case of data in address order: another piece of last segment
+                add_piece(last[2], data)
+                last[1] += size
+                return
+            if last_end < addr:
+                segments.append([addr, size, add_piece([], data)])
+                starts.append(addr)
+                return
+        # segments i..j-1 overlap or touch [addr, end)
+        i = bisect.bisect_left(starts, addr)
+        if i > 0 and starts[i - 1] + segments[i - 1][1] >= addr:
+            i -= 1
+        j = bisect.bisect_right(starts, end)
+        if i == j:
+            segments.insert(i, [addr, size, add_piece([], data)])
+            starts.insert(i, addr)
+            return
+        start = min(starts[i], addr)
+        last = segments[j - 1]
+        merged_end = max(end, last[0] + last[1])
+        if all(seg_addr + seg_size <= addr or seg_addr >= end for seg_addr, seg_size, pieces in segments[i:j]):
+            # data only touches its neighbours: pieces are joined into one segment
+            merged = []
+            for seg_addr, seg_size, pieces in segments[i:j]:
+                if seg_addr < addr:
+                    merged += pieces
+            add_piece(merged, data)
+            for seg_addr, seg_size, pieces in segments[i:j]:
+                if seg_addr >= end:
+                    merged += pieces
+        else:
+            merged = bytearray(merged_end - start)
+            for seg_addr, seg_size, pieces in segments[i:j]:
+                for piece in pieces:
+                    merged[seg_addr - start : seg_addr - start + len(piece)] = piece
+                    seg_addr += len(piece)
+            merged[addr - start : end - start] = data
+            merged = [merged]
+        segments[i:j] = [[start, merged_end - start, merged]]
+        starts[i:j] = [start]
+
+    def clear(self):
+        # drops all segments, releasing views into memory-mapped files
+        self.segments = []
+        self.starts = []
+
+    @property
+    def start(self):
+        return self.segments[0][0] if self.segments else None
+
+    @property
+    def end(self):
+        return self.segments[-1][0] + self.segments[-1][1] if self.segments else None
+
+    def data_size(self):
+        return sum(size for addr, size, pieces in self.segments)
+
+    def ranges(self):
+        return [(addr, addr + size) for addr, size, pieces in self.segments]
+
+    def to_bytes(self, fill=0x00):
+        # contiguous image from start to end; gaps are filled with fill
+        if not self.segments:
+            return b""
+        start = self.start
+        outp = bytearray([fill]) * (self.end - start)
+        for addr, data in self:
+            outp[addr - start : addr - start + len(data)] = data
+        return bytes(outp)
+
+    def blocks(self, size=256, origin=0):
+        # yields (address, data) of each size-byte block at address origin + n * size
+        # which has any data in it. Blocks fully inside a segment are views of it;
+        # others are zero-filled where there is no data
+        pending_addr, pending = None, None
+        for start, data in self:
+            view = memoryview(data)
+            addr = start
+            end = start + len(view)
+            while addr < end:
+                block_addr = addr - (addr - origin) % size
+                n = min(end, block_addr + size) - addr
+                if pending is not None and pending_addr != block_addr:
+                    yield pending_addr, pending
+                    pending = None
+                if n == size:
+                    yield block_addr, view[addr - start : addr - start + size]
+                else:
+                    if pending is None:
+                        pending_addr, pending = block_addr, bytearray(size)
+                    pending[addr - block_addr : addr - block_addr + n] = view[addr - start : addr - start + n]
+                addr += n
+        if pending is not None:
+            yield pending_addr, pending
+
+    def count_blocks(self, size=256, origin=0):
+        # number of blocks blocks() yields, without going through the data
+        count = 0
+        last = None
+        for addr, data_size, pieces in self.segments:
+            first = (addr - origin) // size
+            final = (addr + data_size - 1 - origin) // size
+            if first == last:
+                first += 1
+            count += final - first + 1
+            last = final
+        return count
+
+def read_uf2(buf):
+    # blocks can come in any order; they are placed by address. Returns image,
+    # whose new segments are views of buf, and report of decode_uf2
+    segments, report = decode_uf2(buf)
+    image = SparseImage()
+    for addr, data in segments:
+        image.add(addr, data)
+    return image, report
+
+def uf2_to_bin(buf):
+    # gaps between blocks are zero-filled. Returns binary image, its start
+    # address (None if empty) and report of decode_uf2
+    image, report = read_uf2(buf)
+    return image.to_bytes(), image.start, report
+
+def convert_from_uf2(buf):
+    outp, start, report = uf2_to_bin(buf)
+    print_uf2_report(report)
     return outp
 
-def convert_to_carray(file_content):
-    outp = "const unsigned char bindata[] __attribute__((aligned(16))) = {"
-    for i in range(len(file_content)):
-        if i % 16 == 0:
-            outp += "\n"
-        outp += "0x%02x, " % ord(file_content[i])
-    outp += "\n};\n"
+def convert_uf2_file_to_bin(input_name, output_name):
+    # memory-maps input file and writes payloads directly to output file, see
+    # write_bin. Returns size of output and its start address (None if empty)
+    with map_file(input_name) as buf, open(output_name, mode='wb') as outp:
+        image, report = read_uf2(buf)
+        print_uf2_report(report)
+        size, start = write_bin(image, outp), image.start
+        # release views into mmap before it is closed
+        image.clear()
+    return size, start
+
+class UF2Reader:
+    # random access to UF2 file through an index of its blocks. The file is
+    # memory-mapped, and only blocks which are actually read are touched.
+    # Index entries are (address, payload size, file offset, flags, family ID or
+    # None, block number, number of blocks), sorted by address; of blocks with
+    # the same address, the last one in file comes last
+    def __init__(self, filename, cache=True):
+        self.filename = filename
+        self.file = open(filename, mode='rb')
+        st = os.fstat(self.file.fileno())
+        self.size = st.st_size
+        self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+        self.key = [st.st_size, st.st_mtime_ns]
+        self.index = None
+        if cache:
+            self.load_index()
+        if self.index is None:
+            self.build_index()
+            if cache:
+                self.save_index()
+        self.addresses = [entry[0] for entry in self.index]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+        self.file.close()
+
+    def build_index(self):
+        self.index = []
+        # offsets of blocks with bad magic or payload size
+        self.skipped = []
+        for ptr in range(0, self.size - 511, 512):
+            hd = UF2_HEADER.unpack_from(self.buf, ptr)
+            flags, addr, datalen, blockno, numblocks = hd[2:7]
+            if hd[0] != UF2_MAGIC_START0 or hd[1] != UF2_MAGIC_START1 or datalen > 476:
+                self.skipped.append(ptr)
+                continue
+            family = hd[7] if flags & 0x2000 else None
+            self.index.append((addr, datalen, ptr, flags, family, blockno, numblocks))
+        self.index.sort(key=lambda entry: (entry[0], entry[2]))
+
+    def load_index(self):
+        try:
+            with open(self.filename + UF2_INDEX_SUFFIX, mode='rb') as f:
+                data = f.read()
+            magic, size, mtime, nskipped, nblocks = UF2_INDEX_HEADER.unpack_from(data)
+            if magic != UF2_INDEX_MAGIC or [size, mtime] != self.key:
+                return
+            ptr = UF2_INDEX_HEADER.size
+            skipped = list(struct.unpack_from("<%dI" % nskipped, data, ptr))
+            ptr += 4 * nskipped
+            entries = data[ptr : ptr + UF2_INDEX_ENTRY.size * nblocks]
+            if len(entries) != UF2_INDEX_ENTRY.size * nblocks:
+                return
+            # family ID is stored as 0 if the block has none
+            self.index = [(addr, size, offset, flags, family if flags & 0x2000 else None, blockno, numblocks)
+                          for addr, size, offset, flags, family, blockno, numblocks
+                          in UF2_INDEX_ENTRY.iter_unpack(entries)]
+            self.skipped = skipped
+        except (OSError, struct.error):
+            pass
+
+    def save_index(self):
+        index_name = self.filename + UF2_INDEX_SUFFIX
+        temp_name = "%s.%d.%d.tmp" % (index_name, os.getpid(), threading.get_ident())
+        data = bytearray(UF2_INDEX_HEADER.pack(UF2_INDEX_MAGIC, self.key[0], self.key[1],
+                                               len(self.skipped), len(self.index)))
+        data += struct.pack("<%dI" % len(self.skipped), *self.skipped)
+        for addr, size, offset, flags, family, blockno, numblocks in self.index:
+            data += UF2_INDEX_ENTRY.pack(addr, size, offset, flags, family or 0, blockno, numblocks)
+        try:
+            with open(temp_name, mode='wb') as f:
+                f.write(data)
+            os.replace(temp_name, index_name)
+        except OSError:
+            # e.g. read-only directory; index is just not cached
+            pass
+
+    def ranges(self, family=None):
+        # returns list of (start, end) of contiguous address ranges of blocks to
+        # be flashed; if family is given, only blocks of that family are used
+        ranges = []
+        for addr, size, offset, flags, fam, blockno, numblocks in self.index:
+            if flags & 1 or (family is not None and fam != family):
+                continue
+            if ranges and addr <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], addr + size)
+            else:
+                ranges.append([addr, addr + size])
+        return [tuple(r) for r in ranges]
+
+    def info(self):
+        # summary of the file: blocks of each family, address ranges, flags used,
+        # and missing or duplicate block numbers, as decode_uf2 reports them
+        families = {}
+        flags_used = 0
+        seen = {}
+        duplicate = []
+        for addr, size, offset, flags, family, blockno, numblocks in self.index:
+            flags_used |= flags
+            f = families.setdefault(family, {"blocks": 0, "bytes": 0, "no_flash": 0})
+            f["blocks"] += 1
+            if flags & 1:
+                f["no_flash"] += 1
+            else:
+                f["bytes"] += size
+            blocknos = seen.setdefault((family or 0, numblocks), set())
+            if blockno in blocknos:
+                duplicate.append(blockno)
+            blocknos.add(blockno)
+        for family, f in families.items():
+            f["ranges"] = self.ranges(family)
+        missing = [n for (family, numblocks), blocknos in seen.items()
+                   for n in range(numblocks) if n not in blocknos]
+        return {"file": self.filename, "size": self.size, "blocks": len(self.index),
+                "skipped": len(self.skipped), "families": families,
+                "flags": [name for bit, name in UF2_FLAGS.items() if flags_used & bit],
+                "duplicate": sorted(duplicate), "missing": missing}
+
+    def read(self, start, end, family=None, fill=0x00):
+        # returns contents of address range [start, end), as it would be flashed;
+        # addresses not covered by any block are filled with fill
+        outp = bytearray([fill]) * (end - start)
+        # payloads are at most 476 bytes, so no block starting before this
+        # address can overlap the range
+        i = bisect.bisect_left(self.addresses, start - 476)
+        while i < len(self.index) and self.index[i][0] < end:
+            addr, size, offset, flags, fam, blockno, numblocks = self.index[i]
+            i += 1
+            if flags & 1 or (family is not None and fam != family) or addr + size <= start:
+                continue
+            lo = max(addr, start)
+            hi = min(addr + size, end)
+            outp[lo - start : hi - start] = self.buf[offset + 32 + lo - addr : offset + 32 + hi - addr]
+        return bytes(outp)
+
+    def to_dict(self):
+        keys = ["address", "size", "offset", "flags", "family", "blockno", "numblocks"]
+        return {"file": self.filename, "size": self.size, "skipped": self.skipped,
+                "blocks": [dict(zip(keys, entry)) for entry in self.index]}
+
+def family_name(family):
+    for name, value in families.items():
+        if value == family:
+            return name
+    return "none" if family is None else "0x%08x" % family
+
+def print_uf2_info(info):
+    print("%s: %d bytes, %d blocks, %d skipped" %
+          (info["file"], info["size"], info["blocks"], info["skipped"]))
+    if info["flags"]:
+        print("Flags: " + ", ".join(info["flags"]))
+    for family, f in info["families"].items():
+        print("Family %s: %d blocks, %d bytes to flash, %d not to flash" %
+              (family_name(family), f["blocks"], f["bytes"], f["no_flash"]))
+        for start, end in f["ranges"]:
+            print("  0x%08x-0x%08x (%d bytes)" % (start, end, end - start))
+    if info["duplicate"]:
+        print("Duplicate blocks: " + ", ".join(map(str, info["duplicate"])))
+    if info["missing"]:
+        print("Missing blocks: " + ", ".join(map(str, info["missing"])))
+
+def print_uf2_blocks(reader):
+    print("%8s %10s %6s %10s %10s %10s %s" %
+          ("offset", "address", "size", "block", "family", "flags", "flag names"))
+    for addr, size, offset, flags, family, blockno, numblocks in sorted(reader.index, key=lambda entry: entry[2]):
+        names = ",".join(name for bit, name in UF2_FLAGS.items() if flags & bit)
+        print("%8d 0x%08x %6d %5d/%-4d %10s 0x%08x %s" %
+              (offset, addr, size, blockno, numblocks, family_name(family), flags, names))
+
+def parse_range(text):
+    # address range as START:END or START+SIZE, numbers in any base
+    if "+" in text:
+        start, size = text.split("+", 1)
+        return int(start, 0), int(start, 0) + int(size, 0)
+    start, end = text.split(":", 1)
+    return int(start, 0), int(end, 0)
+
+def crc16(data, crc=0):
+    # CRC16-CCITT (polynomial 0x1021), as used by the bootloader self updater;
+    # binascii.crc_hqx computes exactly this, table-driven in C
+    return binascii.crc_hqx(data, crc)
+
+def block_crcs(data, block_size=1024):
+    # returns list of CRCs of each block_size bytes of data
+    return [crc16(data[i:i + block_size]) for i in range(0, len(data), block_size)]
+
+C_VALUE_TYPES = {1: "B", 2: "H", 4: "I"}
+
+def format_c_values(data, width=1, per_row=16):
+    # formats data as rows of comma-separated C hex literals, each row ending
+    # in ",\n"; width is element size in bytes (little endian), data length
+    # must be a multiple of it. All full rows are formatted with one % operation
+    values = struct.unpack("<%d%s" % (len(data) // width, C_VALUE_TYPES[width]), data)
+    literal = "0x%%0%dx" % (2 * width)
+    full_rows = len(values) // per_row
+    row_format = ", ".join([literal] * per_row) + ",\n"
+    text = (row_format * full_rows) % values[:full_rows * per_row]
+    rest = values[full_rows * per_row:]
+    if rest:
+        text += ", ".join([literal] * len(rest)) % rest + ",\n"
+    return text
+
+def convert_to_carray(file_content, name="bindata", width=8, align=16,
+                      section=None, crc_block=None):
+    # width is element size in bits; data is padded with zeros to a whole
+    # element. If crc_block is set, also emits CRC16 of each crc_block bytes
+    # as <name>_crcs, like scripts/gendata.py does for the self updater
+    size = width // 8
+    data = bytes(file_content) + bytes(-len(file_content) % size)
+    ctype = {8: "unsigned char", 16: "uint16_t", 32: "uint32_t"}[width]
+    outp = ""
+    if width != 8 or crc_block:
+        outp += "#include <stdint.h>\n"
+    outp += "const %s %s[]" % (ctype, name)
+    if section:
+        outp += ' __attribute__((section("%s")))' % section
+    if align:
+        outp += " __attribute__((aligned(%d)))" % align
+    outp += " = {\n" + format_c_values(data, size, 16 // size) + "};\n"
+    if crc_block:
+        crcs = ["0x%04x" % crc for crc in block_crcs(data, crc_block)]
+        outp += "const uint16_t %s_crcs[] = {%s};\n" % (name, ", ".join(crcs))
     return outp
 
-def convert_to_uf2(file_content):
-    global familyid
-    datapadding = b""
-    while len(datapadding) < 512 - 256 - 32 - 4:
-        datapadding += b"\x00\x00\x00\x00"
-    numblocks = (len(file_content) + 255) // 256
-    outp = b""
-    for blockno in range(numblocks):
-        ptr = 256 * blockno
-        chunk = file_content[ptr:ptr + 256]
-        flags = 0x0
-        if familyid:
-            flags |= 0x2000
-        hd = struct.pack(b"<IIIIIIII",
+def write_uf2(image, outp, family=0x0, origin=0):
+    # writes image to file object outp as 256-byte UF2 blocks at addresses
+    # origin + n * 256, STREAM_BLOCKS blocks at a time; returns size written
+    numblocks = image.count_blocks(256, origin)
+    flags = 0x0
+    if family:
+        flags |= 0x2000
+    # bytes after payload stay zero, as blocks always carry 256 bytes
+    chunk_blocks = min(numblocks, STREAM_BLOCKS)
+    outbuf = bytearray(512 * chunk_blocks)
+    count = 0
+    for blockno, (addr, data) in enumerate(image.blocks(256, origin)):
+        ptr = 512 * count
+        UF2_HEADER.pack_into(outbuf, ptr,
             UF2_MAGIC_START0, UF2_MAGIC_START1,
-            flags, ptr + appstartaddr, 256, blockno, numblocks, familyid)
-        while len(chunk) < 256:
-            chunk += b"\x00"
-        block = hd + chunk + datapadding + struct.pack(b"<I", UF2_MAGIC_END)
-        assert len(block) == 512
-        outp += block
-    return outp
+            flags, addr, 256, blockno, numblocks, family)
+        outbuf[ptr + 32 : ptr + 288] = data
+        outbuf[ptr + 508 : ptr + 512] = UF2_END
+        count += 1
+        if count == chunk_blocks:
+            outp.write(outbuf)
+            count = 0
+    outp.write(memoryview(outbuf)[:512 * count])
+    return 512 * numblocks
+
+def convert_to_uf2(file_content, base=0x2000, family=0x0):
+    outp = io.BytesIO()
+    write_uf2(read_bin(file_content, base), outp, family, base)
+    return outp.getvalue()
+
+def convert_file_to_uf2(input_name, output_name, base=0x2000, family=0x0):
+    # streaming version of convert_to_uf2: input is memory-mapped, and output
+    # written STREAM_BLOCKS blocks at a time, so memory use doesn't depend on
+    # file size
+    with map_file(input_name) as buf, open(output_name, mode='wb') as outp:
+        image = read_bin(buf, base)
+        size = write_uf2(image, outp, family, base)
+        # release views into mmap before it is closed
+        image.clear()
+    return size
 
 class Block:
     def __init__(self, addr):
         self.addr = addr
         self.bytes = bytearray(256)
 
-    def encode(self, blockno, numblocks):
-        global familyid
+    def encode(self, blockno, numblocks, family=0x0):
         flags = 0x0
-        if familyid:
+        if family:
             flags |= 0x2000
-        hd = struct.pack("<IIIIIIII",
+        hd = UF2_HEADER.pack(
             UF2_MAGIC_START0, UF2_MAGIC_START1,
-            flags, self.addr, 256, blockno, numblocks, familyid)
-        hd += self.bytes[0:256]
-        while len(hd) < 512 - 4:
-            hd += b"\x00"
-        hd += struct.pack("<I", UF2_MAGIC_END)
-        return hd
-
-def convert_from_hex_to_uf2(buf):
-    global appstartaddr
-    appstartaddr = None
-    upper = 0
-    currblock = None
-    blocks = []
-    for line in buf.split('\n'):
-        if line[0] != ":":
+            flags, self.addr, 256, blockno, numblocks, family)
+        return hd + self.bytes + bytes(512 - 4 - 32 - 256) + UF2_END
+
+def parse_hex_records(lines):
+    # yields (type, address, data) for each record of Intel HEX file;
+    # lines can be any iterable of strings, e.g. an open file
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line[0] != ":":
             continue
-        i = 1
-        rec = []
-        while i < len(line) - 1:
-            rec.append(int(line[i:i+2], 16))
-            i += 2
-        tp = rec[3]
+        try:
+            rec = bytes.fromhex(line[1:])
+        except ValueError:
+            raise ValueError("Invalid HEX record at line %d" % lineno)
+        if len(rec) < 5 or len(rec) != rec[0] + 5:
+            raise ValueError("Invalid HEX record length at line %d" % lineno)
+        if sum(rec) & 0xff:
+            raise ValueError("HEX record checksum mismatch at line %d" % lineno)
+        yield rec[3], (rec[1] << 8) | rec[2], memoryview(rec)[4:-1]
+
+def read_hex(lines):
+    # reads data records of HEX file into image; lines can be any iterable of
+    # strings, e.g. an open file
+    image = SparseImage()
+    upper = 0
+    for tp, offset, data in parse_hex_records(lines):
         if tp == 4:
-            upper = ((rec[4] << 8) | rec[5]) << 16
+            # extended linear address
+            upper = ((data[0] << 8) | data[1]) << 16
         elif tp == 2:
-            upper = ((rec[4] << 8) | rec[5]) << 4
-            assert (upper & 0xffff) == 0
+            # extended segment address
+            upper = ((data[0] << 8) | data[1]) << 4
         elif tp == 1:
             break
         elif tp == 0:
-            addr = upper | (rec[1] << 8) | rec[2]
-            if appstartaddr == None:
-                appstartaddr = addr
-            i = 4
-            while i < len(rec) - 1:
-                if not currblock or currblock.addr & ~0xff != addr & ~0xff:
-                    currblock = Block(addr & ~0xff)
-                    blocks.append(currblock)
-                currblock.bytes[addr & 0xff] = rec[i]
-                addr += 1
-                i += 1
+            image.add(upper + offset, data)
+    return image
+
+def hex_record(tp, offset, data):
+    rec = bytes((len(data), offset >> 8, offset & 0xff, tp)) + bytes(data)
+    return ":%s%02X\n" % (rec.hex().upper(), -sum(rec) & 0xff)
+
+def piece_reader(pieces):
+    # returns function which reads the next n bytes of contiguous pieces; bytes
+    # within one piece are a view of it, others are joined
+    views = [memoryview(piece) for piece in pieces]
+    index, offset = 0, 0
+    def read(n):
+        nonlocal index, offset
+        parts = []
+        while n:
+            view = views[index]
+            m = min(n, len(view) - offset)
+            parts.append(view[offset : offset + m])
+            offset += m
+            n -= m
+            if offset == len(view):
+                index, offset = index + 1, 0
+        return parts[0] if len(parts) == 1 else b"".join(parts)
+    return read
+
+def write_hex(image, outp, record_size=16):
+    # writes image to file object outp as Intel HEX: data records of up to
+    # record_size bytes, which don't cross 64K boundaries, and an extended
+    # linear address record wherever the upper 16 address bits change.
+    # Returns size written
+    upper = None
+    lines = []
+    size = 0
+    for start, data_size, pieces in image.segments:
+        # records run on across pieces of a segment
+        read = piece_reader(pieces)
+        ptr = 0
+        while ptr < data_size:
+            addr = start + ptr
+            if addr >> 16 != upper:
+                upper = addr >> 16
+                lines.append(hex_record(4, 0, struct.pack(">H", upper)))
+            n = min(record_size, data_size - ptr, 0x10000 - (addr & 0xffff))
+            lines.append(hex_record(0, addr & 0xffff, read(n)))
+            ptr += n
+            if len(lines) >= STREAM_BLOCKS:
+                size += outp.write("".join(lines).encode("ascii"))
+                lines = []
+    lines.append(hex_record(1, 0, b""))
+    size += outp.write("".join(lines).encode("ascii"))
+    return size
+
+def read_bin(buf, base=0x2000):
+    image = SparseImage()
+    image.add(base, buf)
+    return image
+
+def write_bin(image, outp):
+    # writes image to file object outp from its start address; gaps are
+    # skipped over with seek, leaving holes instead of writing zeros.
+    # Returns size written
+    if image.start is None:
+        return 0
+    pos = image.start
+    for addr, data in image:
+        if addr != pos:
+            outp.seek(addr - image.start)
+        outp.write(data)
+        pos = addr + len(data)
+    outp.truncate(image.end - image.start)
+    return image.end - image.start
+
+def read_image(buf, base=0x2000):
+    # reads image in any format (BIN placed at base, HEX or UF2) from memory;
+    # returns image, format and report of decode_uf2 (None if not UF2)
+    if is_uf2(buf):
+        image, report = read_uf2(buf)
+        return image, "uf2", report
+    if is_hex(buf):
+        return read_hex(to_str(buf).splitlines()), "hex", None
+    return read_bin(buf, base), "bin", None
+
+@contextlib.contextmanager
+def map_file(input_name):
+    # memory-maps file for reading; an empty file can't be mapped, so b"" is
+    # used for it
+    with open(input_name, mode='rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            yield buf
+
+@contextlib.contextmanager
+def open_image(input_name, base=0x2000):
+    # reads image file in any format, like read_image, and yields (image,
+    # format, report). BIN and UF2 files are memory-mapped, so the image only
+    # holds copies of data where blocks had to be merged; HEX files are read
+    # line by line. The image can't be used after the with block
+    with open(input_name, mode='rb') as f:
+        head = f.read(512)
+    if not is_uf2(head) and is_hex(head):
+        with open(input_name, mode='r', encoding='utf-8') as f:
+            yield read_hex(f), "hex", None
+        return
+    with map_file(input_name) as buf:
+        image, fmt, report = read_image(buf, base)
+        try:
+            yield image, fmt, report
+        finally:
+            # release views into mmap before it is closed
+            image.clear()
+
+def write_image(image, outp, fmt, family=0x0, origin=0):
+    # writes image to file object outp in given format; returns size written
+    if fmt == "uf2":
+        return write_uf2(image, outp, family, origin)
+    if fmt == "hex":
+        return write_hex(image, outp)
+    return write_bin(image, outp)
+
+def encode_blocks(blocks, family=0x0):
     numblocks = len(blocks)
-    resfile = b""
-    for i in range(0, numblocks):
-        resfile += blocks[i].encode(i, numblocks)
-    return resfile
+    return b"".join(block.encode(i, numblocks, family) for i, block in enumerate(blocks))
+
+def convert_from_hex_to_uf2(buf, family=0x0):
+    outp = io.BytesIO()
+    write_uf2(read_hex(buf.splitlines()), outp, family)
+    return outp.getvalue()
+
+def convert_hex_file_to_uf2(input_name, family=0x0):
+    # reads HEX file line by line instead of loading it into memory first
+    outp = io.BytesIO()
+    with open(input_name, mode='r', encoding='utf-8') as f:
+        write_uf2(read_hex(f), outp, family)
+    return outp.getvalue()
+
+def image_blocks(buf, base=0x2000):
+    # splits image in any format (BIN placed at base, HEX or UF2) into 256-byte
+    # blocks; returns list of Block objects sorted by address. Blocks are laid
+    # out as in a UF2 file made from the same image (those of BIN start at
+    # base), and parts not covered by the image are zero-filled
+    image, fmt, report = read_image(buf, base)
+    if report:
+        print_uf2_report(report)
+    blocks = []
+    for addr, data in image.blocks(256, base if fmt == "bin" else 0):
+        block = Block(addr)
+        block.bytes[:] = data
+        blocks.append(block)
+    return blocks
+
+def block_digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def block_index(input_name, base=0x2000):
+    # returns {block address: digest} of image file. The index is cached next
+    # to the file and only rebuilt if the file, or base address, changes
+    st = os.stat(input_name)
+    key = [BLOCK_INDEX_VERSION, st.st_size, st.st_mtime_ns, base]
+    index_name = input_name + BLOCK_INDEX_SUFFIX
+    try:
+        with open(index_name, mode='r') as f:
+            cached = json.load(f)
+        if cached["key"] == key:
+            return {int(addr): digest for addr, digest in cached["blocks"].items()}
+    except (OSError, ValueError, KeyError):
+        pass
+    with open(input_name, mode='rb') as f:
+        index = {block.addr: block_digest(block.bytes) for block in image_blocks(f.read(), base)}
+    try:
+        # unique name, so that several processes can build the index at once
+        temp_name = "%s.%d.%d.tmp" % (index_name, os.getpid(), threading.get_ident())
+        with open(temp_name, mode='w') as f:
+            json.dump({"key": key, "blocks": index}, f)
+        os.replace(temp_name, index_name)
+    except OSError:
+        # e.g. read-only directory; index is just not cached
+        pass
+    return index
+
+def convert_to_delta_uf2(buf, base_index, base=0x2000, family=0x0):
+    # returns (UF2 with only those blocks of image buf which differ from the
+    # image indexed in base_index, number of blocks in image); blocks are
+    # numbered 0..n-1 of n blocks in the delta, so the bootloader accepts it
+    all_blocks = image_blocks(buf, base)
+    blocks = [block for block in all_blocks
+              if base_index.get(block.addr) != block_digest(block.bytes)]
+    return encode_blocks(blocks, family), len(all_blocks)
 
 def to_str(b):
     return b.decode("utf-8")
 
-def get_drives():
+def mounted_fat_drives(mounts_file=MOUNTS_FILE):
+    # mount points of FAT file systems, from /proc/mounts (or a file in the same format)
+    drives = []
+    with open(mounts_file, mode='r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 3 and fields[2] in UF2_FILESYSTEMS:
+                # spaces etc. in mount points are escaped as octal, e.g. \040
+                drives.append(re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), fields[1]))
+    return drives
+
+def get_drives(mounts_file=MOUNTS_FILE):
     drives = []
     if sys.platform == "win32":
         r = subprocess.check_output(["wmic", "PATH", "Win32_LogicalDisk",
@@ -182,16 +843,23 @@ def get_drives():
             words = re.split('\s+', line)
             if len(words) >= 3 and words[1] == "2" and words[2] == "FAT":
                 drives.append(words[0])
+    elif os.path.isfile(mounts_file):
+        drives = mounted_fat_drives(mounts_file)
     else:
         rootpath = "/media"
         if sys.platform == "darwin":
             rootpath = "/Volumes"
         elif sys.platform == "linux":
-            tmp = rootpath + "/" + os.environ["USER"]
+            try:
+                tmp = rootpath + "/" + getpass.getuser()
+            except (KeyError, OSError):
+                # no USER/LOGNAME and no passwd entry, e.g. in a container
+                tmp = rootpath
             if os.path.isdir(tmp):
                 rootpath = tmp
-        for d in os.listdir(rootpath):
-            drives.append(os.path.join(rootpath, d))
+        if os.path.isdir(rootpath):
+            for d in os.listdir(rootpath):
+                drives.append(os.path.join(rootpath, d))
 
 
     def has_info(d):
@@ -204,11 +872,21 @@ def get_drives():
 
 
 def board_id(path):
-    with open(path + INFO_FILE, mode='r') as file:
+    # INFO_UF2.TXT written by some bootloaders isn't valid UTF-8
+    with open(path + INFO_FILE, mode='r', errors='replace') as file:
         file_content = file.read()
     return re.search("Board-ID: ([^\r\n]*)", file_content).group(1)
 
 
+def board_id_from_config(config_name):
+    # BOARD_ID as defined in board_config.h of the bootloader
+    with open(config_name, mode='r') as file:
+        match = re.search(r'#define\s+BOARD_ID\s+"([^"]*)"', file.read())
+    if match is None:
+        raise ValueError("No BOARD_ID in %s" % config_name)
+    return match.group(1)
+
+
 def list_drives():
     for d in get_drives():
         print(d, board_id(d))
@@ -220,21 +898,221 @@ def write_file(name, buf):
     print("Wrote %d bytes to %s" % (len(buf), name))
 
 
+def flash_drive(drive, buf, chunk_size=WRITE_CHUNK):
+    # writes UF2 file to one drive in chunks and makes sure it reached the device;
+    # returns time taken in seconds
+    start = time.perf_counter()
+    view = memoryview(buf)
+    with open(os.path.join(drive, "NEW.UF2"), "wb") as f:
+        for ptr in range(0, len(view), chunk_size):
+            f.write(view[ptr:ptr + chunk_size])
+        f.flush()
+        os.fsync(f.fileno())
+    return time.perf_counter() - start
+
+def flash_drives(drives, buf, expected_board_id=None, jobs=None, chunk_size=WRITE_CHUNK):
+    # flashes all drives at once with a pool of threads. Drives whose Board-ID differs
+    # from expected_board_id (if given) are skipped. Returns list of dictionaries with
+    # keys drive, board_id, status ('ok', 'skipped' or 'failed'), seconds and error
+    def flash(drive):
+        result = {"drive": drive, "board_id": None, "status": "failed",
+                  "size": len(buf), "seconds": 0.0, "error": None}
+        try:
+            result["board_id"] = board_id(drive)
+            if expected_board_id is not None and result["board_id"] != expected_board_id:
+                result["status"] = "skipped"
+                result["error"] = "Board-ID %s, expected %s" % (result["board_id"], expected_board_id)
+                return result
+            result["seconds"] = flash_drive(drive, buf, chunk_size)
+            result["status"] = "ok"
+        except (OSError, ValueError, AttributeError) as e:
+            # AttributeError: INFO_UF2.TXT without Board-ID; any other error
+            # reading one drive fails that drive only
+            result["error"] = str(e) or type(e).__name__
+        return result
+    if not drives:
+        return []
+    with ThreadPoolExecutor(max_workers=jobs or len(drives)) as executor:
+        return list(executor.map(flash, drives))
+
+def print_flash_report(results):
+    for r in results:
+        if r["status"] == "ok":
+            rate = r["size"] / r["seconds"] / 1024 if r["seconds"] else float("inf")
+            print("Flashed %s (%s): %d bytes in %.2f s, %.1f KB/s" %
+                  (r["drive"], r["board_id"], r["size"], r["seconds"], rate))
+        else:
+            print("%s %s: %s" % (r["status"].capitalize(), r["drive"], r["error"]))
+    ok = sum(1 for r in results if r["status"] == "ok")
+    failed = sum(1 for r in results if r["status"] == "failed")
+    print("%d flashed, %d skipped, %d failed" % (ok, len(results) - ok - failed, failed))
+
+
+class Converter:
+    # conversion settings: base address of BIN files and family ID of UF2 output.
+    # Converting doesn't change any state, so one converter can be used by
+    # several threads at once
+    def __init__(self, base=0x2000, family=0x0):
+        self.base = base
+        self.family = family
+
+    def write(self, image, fmt, to, outp):
+        # writes image read from format fmt in format to; UF2 blocks of BIN
+        # input start at base, of other input at multiples of 256
+        return write_image(image, outp, to, self.family, self.base if fmt == "bin" else 0)
+
+    def metadata(self, image, fmt, to, size):
+        info = {"from": fmt, "to": to, "size": size, "start": image.start, "ranges": image.ranges()}
+        if to == "uf2":
+            info["blocks"] = size // 512
+        return info
+
+    def convert(self, buf, to=None):
+        # converts image in any format to format to in memory; by default BIN
+        # and HEX are converted to UF2, and UF2 to BIN. Returns output and
+        # metadata (formats, size, start address, address ranges, UF2 blocks
+        # or report of UF2 input)
+        image, fmt, report = read_image(buf, self.base)
+        to = to or ("bin" if fmt == "uf2" else "uf2")
+        outp = io.BytesIO()
+        size = self.write(image, fmt, to, outp)
+        info = self.metadata(image, fmt, to, size)
+        if report is not None:
+            info["report"] = report
+        return outp.getvalue(), info
+
+    def convert_file(self, input_name, output_name=None, to=None):
+        # converts file, streaming where possible; output format defaults to the
+        # extension of output name if that is a known format, and output name
+        # to input name with new extension. Output is written to a temporary
+        # file which is then renamed, so it is never seen half-written. Returns
+        # metadata, including input and output names
+        if to is None and output_name is not None:
+            ext = os.path.splitext(output_name)[1][1:].lower()
+            if ext in IMAGE_FORMATS:
+                to = ext
+        with open_image(input_name, self.base) as (image, fmt, report):
+            if report is not None:
+                print_uf2_report(report)
+            to = to or ("bin" if fmt == "uf2" else "uf2")
+            if output_name is None:
+                output_name = os.path.splitext(input_name)[0] + "." + to
+            # unique per thread and process, in the same directory as output
+            temp_name = "%s.%d.%d.tmp" % (output_name, os.getpid(), threading.get_ident())
+            try:
+                with open(temp_name, mode='wb') as outp:
+                    size = self.write(image, fmt, to, outp)
+                os.replace(temp_name, output_name)
+            except BaseException:
+                if os.path.exists(temp_name):
+                    os.remove(temp_name)
+                raise
+            info = self.metadata(image, fmt, to, size)
+        info["input"] = input_name
+        info["output"] = output_name
+        return info
+
+def convert_file(input_name, base=0x2000, family=0x0, output_name=None, to=None):
+    # converts one file, choosing output format and name the same way as main();
+    # returns metadata, see Converter.convert_file
+    return Converter(base, family).convert_file(input_name, output_name, to)
+
+def default_output_name(input_name, to=None):
+    # output name used by Converter.convert_file if none is given: input name
+    # with extension of output format, which is BIN for UF2 input and UF2 otherwise
+    if to is None:
+        with open(input_name, mode='rb') as f:
+            to = "bin" if is_uf2(f.read(8)) else "uf2"
+    return os.path.splitext(input_name)[0] + "." + to
+
+def check_output_names(input_names, output_names, to=None):
+    # returns output names with default names filled in; raises ValueError if
+    # several inputs would be written to the same file, e.g. a.bin and a.hex
+    # both to a.uf2. Inputs which can't be read are left to fail on conversion
+    resolved = []
+    outputs = {}
+    for input_name, output_name in zip(input_names, output_names):
+        if output_name is None:
+            try:
+                output_name = default_output_name(input_name, to)
+            except OSError:
+                resolved.append(None)
+                continue
+        resolved.append(output_name)
+        path = os.path.normcase(os.path.abspath(output_name))
+        outputs.setdefault(path, []).append(input_name)
+    for path, inputs in outputs.items():
+        if len(inputs) > 1:
+            raise ValueError("%s would be written by several inputs: %s; give output names in a manifest" %
+                             (path, ", ".join(inputs)))
+    return resolved
+
+def convert_files(input_names, base=0x2000, family=0x0, jobs=None,
+                  output_names=None, threads=False, to=None):
+    # converts many files at once with a pool of worker processes (or threads);
+    # returns list of metadata of each file, in the same order. If conversion of
+    # a file fails, its metadata only has input name and error message. Raises
+    # ValueError before converting anything if two outputs would have the same name
+    if output_names is None:
+        output_names = [None] * len(input_names)
+    output_names = check_output_names(input_names, output_names, to)
+    pool = ThreadPoolExecutor if threads else ProcessPoolExecutor
+    results = []
+    with pool(max_workers=jobs) as executor:
+        futures = [executor.submit(convert_file, name, base, family, output_name, to)
+                   for name, output_name in zip(input_names, output_names)]
+        for name, future in zip(input_names, futures):
+            try:
+                results.append(future.result())
+            except (OSError, ValueError) as e:
+                results.append({"input": name, "error": str(e)})
+    return results
+
+def batch_inputs(paths, extensions=(".bin", ".hex")):
+    # expands directories into all files with given extensions in them
+    # (recursively); other paths are used as they are
+    names = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                names += [os.path.join(dirpath, name) for name in sorted(filenames)
+                          if os.path.splitext(name)[1].lower() in extensions]
+        else:
+            names.append(path)
+    return names
+
+def read_manifest(manifest_name):
+    # reads list of files to convert: one input file per line, optionally
+    # followed by output file name; relative names are relative to manifest.
+    # Empty lines and lines starting with # are ignored
+    directory = os.path.dirname(os.path.abspath(manifest_name))
+    input_names, output_names = [], []
+    with open(manifest_name, mode='r', encoding='utf-8') as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            input_names.append(os.path.join(directory, fields[0]))
+            output_names.append(os.path.join(directory, fields[1]) if len(fields) > 1 else None)
+    return input_names, output_names
+
 def main():
-    global appstartaddr, familyid
     def error(msg):
         print(msg)
         sys.exit(1)
     parser = argparse.ArgumentParser(description='Convert to UF2 or flash directly.')
-    parser.add_argument('input', metavar='INPUT', type=str, nargs='?',
-                        help='input file (HEX, BIN or UF2)')
+    parser.add_argument('input', metavar='INPUT', type=str, nargs='*',
+                        help='input file (HEX, BIN or UF2); if several files or directories are given, '
+                             'each file (in directories: each BIN and HEX file) is converted to a file '
+                             'with the same name and new extension')
     parser.add_argument('-b' , '--base', dest='base', type=str,
                         default="0x2000",
                         help='set base address of application for BIN format (default: 0x2000)')
     parser.add_argument('-o' , '--output', metavar="FILE", dest='output', type=str,
                         help='write output to named file; defaults to "flash.uf2" or "flash.bin" where sensible')
-    parser.add_argument('-d' , '--device', dest="device_path",
-                        help='select a device path to flash')
+    parser.add_argument('-d' , '--device', dest="device_path", action='append',
+                        help='select a device path to flash; can be given several times')
     parser.add_argument('-l' , '--list', action='store_true',
                         help='list connected devices')
     parser.add_argument('-c' , '--convert', action='store_true',
@@ -246,44 +1124,135 @@ def main():
                         help='specify familyID - number or name (default: 0x0)')
     parser.add_argument('-C' , '--carray', action='store_true',
                         help='convert binary file to a C array, not UF2')
+    parser.add_argument('--carray-name', dest='carray_name', type=str, default="bindata",
+                        help='symbol name of C array (default: bindata)')
+    parser.add_argument('--carray-width', dest='carray_width', type=int, choices=[8, 16, 32], default=8,
+                        help='C array element width in bits (default: 8)')
+    parser.add_argument('--carray-align', dest='carray_align', type=int, default=16,
+                        help='alignment of C array, 0 for none (default: 16)')
+    parser.add_argument('--carray-section', dest='carray_section', type=str, default=None,
+                        help='linker section to place C array in')
+    parser.add_argument('--carray-crc', dest='carray_crc', type=int, default=None, metavar='SIZE',
+                        help='also emit CRC16 of each SIZE bytes of data, e.g. 1024')
+    parser.add_argument('--output-format', dest='output_format', type=str, choices=IMAGE_FORMATS, default=None,
+                        help='convert to this format; default is UF2, or BIN for UF2 input (for several files: '
+                             'or the extension of output name given in manifest)')
+    parser.add_argument('--delta', dest='delta_base', type=str, default=None, metavar='BASE',
+                        help='only include blocks which differ from BASE image (BIN, HEX or UF2) in UF2 output')
+    parser.add_argument('-j' , '--jobs', dest='jobs', type=int, default=None,
+                        help='number of files converted (or devices flashed) at the same time '
+                             '(default: number of CPUs, or all devices)')
+    parser.add_argument('--info', action='store_true',
+                        help='show summary of UF2 file: families, address ranges, flags')
+    parser.add_argument('--ls', action='store_true',
+                        help='list all blocks of UF2 file')
+    parser.add_argument('--extract', dest='extract', type=str, default=None, metavar='RANGE',
+                        help='extract address range START:END or START+SIZE of UF2 file as binary')
+    parser.add_argument('--index-json', dest='index_json', type=str, default=None, metavar='FILE',
+                        help='save index of blocks of UF2 file as JSON')
+    parser.add_argument('--manifest', dest='manifest', type=str, default=None, metavar='FILE',
+                        help='convert files listed in FILE, one "INPUT [OUTPUT]" per line')
+    parser.add_argument('--threads', action='store_true',
+                        help='convert several files with threads instead of processes')
+    parser.add_argument('--board-id', dest='board_id', type=str, default=None,
+                        help='only flash devices with this Board-ID in INFO_UF2.TXT')
+    parser.add_argument('--board-config', dest='board_config', type=str, default=None, metavar='FILE',
+                        help='only flash devices with Board-ID given by BOARD_ID in this board_config.h')
     args = parser.parse_args()
-    appstartaddr = int(args.base, 0)
+    base = int(args.base, 0)
 
     if args.family.upper() in families:
-        familyid = families[args.family.upper()]
+        family = families[args.family.upper()]
     else:
         try:
-            familyid = int(args.family, 0)
+            family = int(args.family, 0)
         except ValueError:
             error("Family ID needs to be a number or one of: " + ", ".join(families.keys()))
 
     if args.list:
         list_drives()
     else:
-        if not args.input:
+        if not args.input and not args.manifest:
             error("Need input file")
+        if args.info or args.ls or args.extract or args.index_json:
+            # inspect UF2 file through its index, without converting it
+            if len(args.input) != 1:
+                error("Need one UF2 file to inspect")
+            with UF2Reader(args.input[0]) as reader:
+                if args.info:
+                    print_uf2_info(reader.info())
+                if args.ls:
+                    print_uf2_blocks(reader)
+                if args.index_json:
+                    with open(args.index_json, mode='w') as f:
+                        json.dump(reader.to_dict(), f, indent=1)
+                if args.extract:
+                    try:
+                        start, end = parse_range(args.extract)
+                    except ValueError:
+                        error("Address range must be START:END or START+SIZE")
+                    write_file(args.output or "flash.bin",
+                               reader.read(start, end, family if family else None))
+            return
+        if len(args.input) > 1 or args.manifest or any(os.path.isdir(name) for name in args.input):
+            if args.output or args.deploy or args.carray or args.delta_base:
+                error("Only conversion is supported for several input files")
+            input_names = batch_inputs(args.input)
+            output_names = [None] * len(input_names)
+            if args.manifest:
+                manifest_inputs, manifest_outputs = read_manifest(args.manifest)
+                input_names += manifest_inputs
+                output_names += manifest_outputs
+            try:
+                results = convert_files(input_names, base, family, args.jobs, output_names, args.threads,
+                                        args.output_format)
+            except ValueError as e:
+                error(str(e))
+            for r in results:
+                if "error" in r:
+                    print("Failed to convert %s: %s" % (r["input"], r["error"]))
+                else:
+                    print("Wrote %d bytes to %s" % (r["size"], r["output"]))
+            failed = sum(1 for r in results if "error" in r)
+            print("%d files converted, %d failed" % (len(results) - failed, failed))
+            if failed:
+                sys.exit(1)
+            return
+        args.input = args.input[0]
         with open(args.input, mode='rb') as f:
             inpbuf = f.read()
         from_uf2 = is_uf2(inpbuf)
         ext = "uf2"
+        start = base
         if args.deploy:
             outbuf = inpbuf
-        elif from_uf2:
-            outbuf = convert_from_uf2(inpbuf)
-            ext = "bin"
-        elif is_hex(inpbuf):
-            outbuf = convert_from_hex_to_uf2(inpbuf.decode("utf-8"))
-        elif args.carray:
-            outbuf = convert_to_carray(inpbuf)
+        elif args.delta_base:
+            outbuf, numblocks = convert_to_delta_uf2(inpbuf, block_index(args.delta_base, base),
+                                                     base, family)
+            print("Delta against %s: %d of %d blocks changed" %
+                  (args.delta_base, len(outbuf) // 512, numblocks))
+            if not outbuf:
+                print("No changes; nothing to write or flash")
+                return
+        elif args.carray and not args.output_format and not from_uf2 and not is_hex(inpbuf):
+            outbuf = convert_to_carray(inpbuf, args.carray_name, args.carray_width,
+                                       args.carray_align, args.carray_section,
+                                       args.carray_crc).encode("utf-8")
             ext = "h"
         else:
-            outbuf = convert_to_uf2(inpbuf)
+            outbuf, info = Converter(base, family).convert(inpbuf, args.output_format)
+            if from_uf2:
+                print_uf2_report(info["report"])
+            ext = info["to"]
+            start = info["start"] or 0
         print("Converting to %s, output size: %d, start address: 0x%x" %
-              (ext, len(outbuf), appstartaddr))
+              (ext, len(outbuf), start))
         if args.convert or ext != "uf2":
             drives = []
             if args.output == None:
                 args.output = "flash." + ext
+        elif args.device_path:
+            drives = args.device_path
         else:
             drives = get_drives()
 
@@ -292,9 +1261,14 @@ def main():
         else:
             if len(drives) == 0:
                 error("No drive to deploy.")
-        for d in drives:
-            print("Flashing %s (%s)" % (d, board_id(d)))
-            write_file(d + "/NEW.UF2", outbuf)
+        expected_board_id = args.board_id
+        if args.board_config:
+            expected_board_id = board_id_from_config(args.board_config)
+        if drives:
+            results = flash_drives(drives, outbuf, expected_board_id, args.jobs)
+            print_flash_report(results)
+            if any(r["status"] == "failed" for r in results):
+                sys.exit(1)
 
 
 if __name__ == "__main__":